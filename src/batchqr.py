@@ -0,0 +1,329 @@
+#!/usr/bin/env python3
+import argparse
+import csv
+import json
+import os
+import sys
+import threading
+import time
+import multiprocessing
+from multiprocessing.connection import wait
+from PIL import Image
+import myqr
+import qrcache
+
+'''
+Replace the QR codes in a whole batch of images.
+
+Usage:
+	batchqr.py --data PAYLOAD --output OUTDIR IMAGEDIR
+	batchqr.py --manifest MANIFEST.csv --output OUTDIR
+
+A manifest is a CSV file of image path, payload rows, with an optional third
+column giving the output path. A row without a payload is reported as failed.
+
+Every image goes through four stages: decode, detect, warp, encode. Each stage
+runs in its own worker processes, connected by bounded queues, so one image can
+be encoded while the next is being scanned and the one after that decoded.
+An image that fails at any stage is reported and the batch carries on. So is one
+whose worker process dies under it, say killed for running out of memory, and the
+stage gets a new worker in its place.
+
+With --cache, detection results are kept on disk keyed by the image's pixels, so
+reruns over the same templates skip straight to the warp.
+'''
+
+STAGE_NAMES = ("decode", "detect", "warp", "encode")
+IMAGE_EXTENSIONS = (".png", ".jpg", ".jpeg", ".bmp", ".gif", ".tif", ".tiff", ".webp")
+#The detect stage's qrcache.DiskCache, set in each worker process by stageWorker
+_detection_cache = None
+#What a stage worker's slot holds when it isn't working on an item
+STARTING, IDLE, FINISHED = -3, -1, -2
+
+
+class StageQueue:
+	'''
+	A queue of items between two stages, shared by every process. Unlike
+	multiprocessing.Queue, put writes the item into the pipe itself rather than leaving
+	it to a feeder thread, so a worker that dies right after passing an item on can't
+	leave half of it in the pipe and garble everything after it.
+	'''
+	def __init__(self, maxsize=0):
+		'''
+		@params:
+			maxsize is how many items may wait before put blocks, 0 for no limit
+		'''
+		self._items = multiprocessing.SimpleQueue()
+		self._free = multiprocessing.BoundedSemaphore(maxsize) if maxsize else None
+
+	def put(self, item):
+		if self._free is not None:
+			self._free.acquire()
+		self._items.put(item)
+
+	def get(self):
+		item = self._items.get()
+		if self._free is not None:
+			self._free.release()
+		return item
+
+
+class BatchItem:
+	'''
+	one image on its way through the pipeline
+	'''
+	def __init__(self, index, path, data, output):
+		self.index = index
+		self.path = path
+		self.data = data
+		self.output = output
+		self.image = None
+		self.pgram = None
+		self.error = None #set by the stage that failed, the item then skips the others
+		self.failed_stage = None
+		self.timings = {}
+
+	def report(self):
+		'''
+		returns a dict describing how this item went, for the JSON report
+		'''
+		return {"path": self.path, "output": self.output, "ok": self.error is None,
+			"failed_stage": self.failed_stage, "error": self.error, "timings": self.timings}
+
+
+def decodeStage(item):
+	item.image = Image.open(item.path).convert("RGB")
+
+def detectStage(item):
+	item.pgram = myqr.scanImage2(item.image, cache=_detection_cache)
+	if item.pgram is None:
+		raise ValueError("no QR code found")
+
+def warpStage(item):
+	item.image = myqr.warpImage(item.image, myqr.makeQRImage(item.data), item.pgram)
+
+def encodeStage(item):
+	item.image.save(item.output)
+	item.image = None #nothing left to do with the pixels, don't ship them back
+
+STAGES = dict(zip(STAGE_NAMES, (decodeStage, detectStage, warpStage, encodeStage)))
+
+
+def stageWorker(name, inbox, outbox, slot, cache_dir=None):
+	'''
+	@params:
+		name is the stage to run, one of STAGE_NAMES
+		inbox is the queue of BatchItems to work on, ending with a None
+		outbox is the queue for the next stage
+		slot is a shared integer holding the index of the item being worked on, or
+			STARTING, IDLE or FINISHED, so runBatch knows what a dead worker took with it
+		cache_dir is the directory of the detection cache, None for no cache
+	runs in a worker process, passing every item on whether it succeeded or not
+	'''
+	global _detection_cache
+	if cache_dir is not None:
+		_detection_cache = qrcache.DiskCache(cache_dir)
+	stage = STAGES[name]
+	slot.value = IDLE
+	while True:
+		item = inbox.get()
+		if item is None:
+			slot.value = FINISHED
+			return
+		slot.value = item.index
+		if item.error is None:
+			start = time.perf_counter()
+			try:
+				stage(item)
+			except Exception as e:
+				item.error = "{}: {}".format(type(e).__name__, e)
+				item.failed_stage = name
+				item.image = None
+			item.timings[name] = time.perf_counter() - start
+		outbox.put(item)
+		slot.value = IDLE
+
+
+def readManifest(path, output_dir):
+	'''
+	@params:
+		path is a CSV file of image path, payload[, output path] rows
+		output_dir is where outputs without an explicit path are written
+	returns a list of (image path, payload, output path) tuples. A row with no payload
+		gets None for one, and runBatch reports it as failed.
+	'''
+	jobs = []
+	with open(path, newline="") as manifest:
+		for row in csv.reader(manifest):
+			if not row or row[0].startswith("#"):
+				continue
+			output = row[2] if len(row) > 2 else os.path.join(output_dir, os.path.basename(row[0]))
+			jobs.append((row[0], row[1] if len(row) > 1 else None, output))
+	return jobs
+
+
+def readDirectory(path, data, output_dir):
+	'''
+	returns a (image path, payload, output path) tuple for every image in directory path
+	'''
+	names = sorted(n for n in os.listdir(path) if n.lower().endswith(IMAGE_EXTENSIONS))
+	return [(os.path.join(path, n), data, os.path.join(output_dir, n)) for n in names]
+
+
+def runBatch(jobs, workers=None, queue_size=4, on_item=None, cache_dir=None):
+	'''
+	@params:
+		jobs is a list of (image path, payload, output path) tuples. Jobs with a payload
+			of None fail straight away.
+		workers is a dict of stage name -> number of processes, 1 each by default
+		queue_size is how many items may wait between two stages
+		on_item is called with each finished BatchItem, in completion order
+		cache_dir is a directory to keep detection results in across runs, see qrcache.DiskCache
+	returns the list of finished BatchItems, in job order. An item in the hands of a
+		worker process that died is failed with the stage it ran, and the worker is
+		replaced, unless it died before taking any item.
+	'''
+	workers = dict(workers or {})
+	counts = [max(workers.get(name, 1), 1) for name in STAGE_NAMES]
+	queues = [StageQueue(queue_size) for name in STAGE_NAMES] + [StageQueue()]
+	slots = {} #worker process -> its slot, see stageWorker
+
+	def spawn(i):
+		slot = multiprocessing.Value("i", STARTING)
+		proc = multiprocessing.Process(target=stageWorker,
+			args=(STAGE_NAMES[i], queues[i], queues[i+1], slot, cache_dir), daemon=True)
+		proc.start()
+		slots[proc] = slot
+		return proc
+
+	stages = [[spawn(i) for n in range(counts[i])] for i in range(len(STAGE_NAMES))]
+
+	def feed():
+		for index, (path, data, output) in enumerate(jobs):
+			item = BatchItem(index, path, data, output)
+			if data is None:
+				item.error = "ValueError: the manifest gives no payload for this image"
+				item.failed_stage = "manifest"
+			queues[0].put(item)
+		for n in range(counts[0]):
+			queues[0].put(None)
+
+	died = {} #stage name -> exit code of its first worker to die
+
+	def drain(i):
+		#Replace the workers of stage i that die, failing the item each had in hand.
+		#Once they are all gone, tell the next stage's workers to finish.
+		name = STAGE_NAMES[i]
+		live = list(stages[i])
+		waiting = 0
+		while live:
+			wait([proc.sentinel for proc in live])
+			for proc in [proc for proc in live if not proc.is_alive()]:
+				live.remove(proc)
+				proc.join()
+				taken = slots[proc].value
+				if proc.exitcode == 0 or taken == FINISHED:
+					continue
+				died.setdefault(name, proc.exitcode)
+				if taken == STARTING:
+					#It can't even start, so its stand-in wouldn't either
+					waiting += 1
+					continue
+				if taken >= 0:
+					item = BatchItem(taken, *jobs[taken])
+					item.failed_stage = name
+					item.error = "RuntimeError: a {} worker died (exit code {})".format(name, proc.exitcode)
+					queues[i+1].put(item)
+				replacement = spawn(i)
+				stages[i].append(replacement)
+				live.append(replacement)
+		#Workers that never started never took their None. Soak up everything still sent
+		#to this stage until those arrive, so the stages before it don't block on a full queue.
+		while waiting:
+			if queues[i].get() is None:
+				waiting -= 1
+		for n in range(counts[i+1] if i + 1 < len(stages) else 1):
+			queues[i+1].put(None)
+
+	threads = [threading.Thread(target=feed, daemon=True)]
+	threads += [threading.Thread(target=drain, args=(i,), daemon=True) for i in range(len(stages))]
+	for thread in threads:
+		thread.start()
+
+	done = [None] * len(jobs)
+	while True:
+		item = queues[-1].get()
+		if item is None:
+			break
+		if done[item.index] is not None:
+			continue #a worker died just after passing it on, and it was failed as well
+		done[item.index] = item
+		if on_item is not None:
+			on_item(item)
+	for thread in threads:
+		thread.join()
+
+	#Whatever never came out was queued for workers that couldn't start, or lost by
+	#one dying between taking it and recording that it had
+	for index, (path, data, output) in enumerate(jobs):
+		if done[index] is None:
+			item = done[index] = BatchItem(index, path, data, output)
+			stage = next((name for name in STAGE_NAMES if name in died), None)
+			item.failed_stage = stage
+			item.error = "RuntimeError: a {} worker died (exit code {})".format(stage, died.get(stage))
+			if on_item is not None:
+				on_item(item)
+	return done
+
+
+def main(argv=None):
+	parser = argparse.ArgumentParser(description="Replace the QR code in a batch of images.")
+	parser.add_argument("directory", nargs="?", help="directory of images to process")
+	parser.add_argument("--manifest", help="CSV of image path, payload[, output path] rows")
+	parser.add_argument("--data", help="payload for every image in directory")
+	parser.add_argument("--output", required=True, help="directory to write results to")
+	parser.add_argument("--queue-size", type=int, default=4, help="items allowed to wait between stages")
+	parser.add_argument("--report", help="write a JSON line per image to this file")
+	parser.add_argument("--cache", help="directory to keep detection results in between runs")
+	for name in STAGE_NAMES:
+		parser.add_argument("--{}-workers".format(name), type=int, default=1,
+			help="processes for the {} stage".format(name))
+	args = parser.parse_args(argv)
+
+	if args.manifest:
+		jobs = readManifest(args.manifest, args.output)
+	elif args.directory and args.data is not None:
+		jobs = readDirectory(args.directory, args.data, args.output)
+	else:
+		parser.error("give either --manifest, or a directory and --data")
+	os.makedirs(args.output, exist_ok=True)
+
+	def printItem(item):
+		if item.error is None:
+			print("ok     {} -> {} ({:.3f}s)".format(item.path, item.output, sum(item.timings.values())))
+		else:
+			print("FAILED {} at {}: {}".format(item.path, item.failed_stage, item.error))
+		sys.stdout.flush()
+
+	workers = {name: getattr(args, name + "_workers") for name in STAGE_NAMES}
+	start = time.perf_counter()
+	done = runBatch(jobs, workers, args.queue_size, printItem, args.cache)
+	elapsed = time.perf_counter() - start
+
+	failed = sum(1 for item in done if item.error is not None)
+	print("{} images in {:.2f}s ({:.2f} images/s), {} failed".format(
+		len(done), elapsed, len(done) / elapsed if elapsed > 0 else 0.0, failed))
+	for name in STAGE_NAMES:
+		times = [item.timings[name] for item in done if name in item.timings]
+		if times:
+			print("  {:<7} {:.3f}s mean over {} images".format(name, sum(times) / len(times), len(times)))
+
+	if args.report:
+		with open(args.report, "w") as report:
+			for item in done:
+				report.write(json.dumps(item.report()) + "\n")
+	return 1 if failed else 0
+
+
+if __name__ == "__main__":
+	sys.exit(main())
@@ -0,0 +1,417 @@
+#!/usr/bin/env python3
+import argparse
+import itertools
+import json
+import math
+import os
+import platform
+import random
+import subprocess
+import sys
+import time
+import tracemalloc
+import numpy as np
+from PIL import Image, ImageDraw
+import myqr
+from mathutil import *
+from mathobjects import *
+
+'''
+Benchmark the detection and warping stages on synthetic scenes with known answers,
+plus the images in TestImages.
+
+Usage:
+	benchqr.py --output results.json
+	benchqr.py --sizes 0.3 4 --per-size 3 --output new.json --compare results.json
+
+A scene is a background of gradients, shapes and noise with one QR code pasted in
+at a random position, rotation, scale and perspective. Because the pasting is done
+here, the true finder pattern centers are known, and the corner error of a stage is
+how far the parallelogram it found is from them, in pixels.
+
+	benchqr.py --check-imports
+
+Every stage of every scene is timed --repeat times (the median is reported), then
+run once more under tracemalloc for its peak memory. Results are written as JSON,
+and --compare prints how each stage's time changed against an earlier results file.
+--binarize benchmarks every scene a second time with binarizeImage run first, as
+findQR(binarize=True) does, and reports the two localization rates side by side.
+
+--check-imports fails if a cold "import myqr" takes longer than IMPORT_BUDGET, or
+drags in any of LAZY_MODULES, which myqr only loads when they are first used.
+'''
+
+STAGE_NAMES = ("binarizeImage", "getMassQRClusters", "constructParallelograms", "warpImage")
+#Scene sizes in megapixels
+SCENE_SIZES = (0.3, 1, 4, 12, 50)
+TEST_IMAGE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "TestImages")
+#Modules of white around a pasted code, as the standard asks for
+QUIET_ZONE = 4
+#Seconds a cold "import myqr" may take
+IMPORT_BUDGET = 0.5
+#Slow imports that only the code paths needing them may load
+LAZY_MODULES = ("sklearn", "scipy", "qrcode")
+
+
+class Scene:
+	'''
+	one image to benchmark, with the finder centers it should be found at if known
+	'''
+	def __init__(self, name, image, payload=None, truth=None, module_size=None):
+		'''
+		@params:
+			name identifies the scene between runs
+			image is the RGB PIL image
+			payload is what the pasted code holds, None for found images
+			truth is the upper left, upper right, lower right and lower left finder centers
+				(the lower right one being where a fourth would be), None if unknown
+			module_size is the pasted code's module size in pixels, roughly
+		'''
+		self.name = name
+		self.image = image
+		self.payload = payload
+		self.truth = truth
+		self.module_size = module_size
+
+
+def applyHomography(coefficients, point):
+	'''
+	returns point mapped by the homography in perspectiveCoefficients form
+	'''
+	a, b, c, d, e, f, g, h = coefficients
+	w = g*point.x + h*point.y + 1
+	return Point((a*point.x + b*point.y + c)/w, (d*point.x + e*point.y + f)/w)
+
+
+def makeBackground(size, rng):
+	'''
+	@params:
+		size is the (width, height) of the background
+		rng is the random.Random to draw from
+	returns an RGB image of a soft gradient covered in random rectangles and ellipses
+	'''
+	width, height = size
+	low = np.array([rng.randrange(256) for i in range(3)], dtype=np.float32)
+	high = np.array([rng.randrange(256) for i in range(3)], dtype=np.float32)
+	ramp = np.linspace(0, 1, width, dtype=np.float32)[:, np.newaxis]
+	row = (low + (high - low)*ramp).astype(np.uint8)
+	background = Image.fromarray(np.broadcast_to(row, (height, width, 3)).copy())
+
+	draw = ImageDraw.Draw(background)
+	megapixels = width*height / 1e6
+	for i in range(int(20 + 10*megapixels)):
+		x0, y0 = rng.uniform(0, width), rng.uniform(0, height)
+		side = rng.uniform(0.01, 0.15) * min(width, height)
+		box = [x0, y0, x0 + side*rng.uniform(0.3, 3), y0 + side*rng.uniform(0.3, 3)]
+		color = tuple(rng.randrange(256) for c in range(3))
+		if rng.random() < 0.5:
+			draw.rectangle(box, fill=color)
+		else:
+			draw.ellipse(box, fill=color)
+	return background
+
+
+def addNoise(image, sigma, seed, strip=512):
+	'''
+	@params:
+		image is an RGB image
+		sigma is the standard deviation of the gaussian noise, in gray levels
+		seed seeds the noise
+		strip is how many rows are noised at a time, to bound the memory used
+	returns a copy of image with gaussian noise added
+	'''
+	if sigma <= 0:
+		return image
+	pixels = np.array(image)
+	rng = np.random.default_rng(seed)
+	for top in range(0, pixels.shape[0], strip):
+		band = pixels[top:top + strip]
+		noise = rng.normal(0, sigma, band.shape).astype(np.float32)
+		band[:] = np.clip(band + noise, 0, 255).astype(np.uint8)
+	return Image.fromarray(pixels)
+
+
+def makeScene(megapixels, index, seed, max_rotation=45, max_skew=.08, max_noise=12):
+	'''
+	@params:
+		megapixels is the size of the scene, at 4:3
+		index numbers scenes of the same size
+		seed seeds everything random about the scene
+		max_rotation is the largest rotation of the code, in degrees
+		max_skew is how far each corner may be pushed, as a fraction of the code's side
+		max_noise is the largest noise sigma, in gray levels
+	returns a Scene with one QR code pasted in
+	'''
+	rng = random.Random("{}-{}-{}".format(seed, megapixels, index))
+	width = int(round(math.sqrt(megapixels*1e6 * 4/3)))
+	height = int(round(width * 3/4))
+	payload = "https://example.com/{}".format(rng.getrandbits(48))
+
+	code = myqr.makeQRImage(payload, box_size=1)
+	modules = code.size[0]
+	padded_modules = modules + 2*QUIET_ZONE
+	module_size = rng.uniform(3, max(3, min(10, 0.5*min(width, height) / padded_modules)))
+	side = padded_modules * module_size
+
+	#Pad the code with its quiet zone at one pixel per module, the warp does the scaling
+	padded = Image.new("RGB", (padded_modules, padded_modules), "white")
+	padded.paste(code.convert("RGB"), (QUIET_ZONE, QUIET_ZONE))
+
+	theta = math.radians(rng.uniform(-max_rotation, max_rotation))
+	reach = side * (abs(math.cos(theta)) + abs(math.sin(theta))) / 2 * (1 + 2*max_skew)
+	center = Point(rng.uniform(reach, width - reach), rng.uniform(reach, height - reach))
+	quad = []
+	for dx, dy in ((-1, -1), (1, -1), (1, 1), (-1, 1)):
+		x = dx*side/2 + rng.uniform(-max_skew, max_skew)*side
+		y = dy*side/2 + rng.uniform(-max_skew, max_skew)*side
+		quad.append(center + Point(x*math.cos(theta) - y*math.sin(theta), x*math.sin(theta) + y*math.cos(theta)))
+
+	background = makeBackground((width, height), rng)
+	scene = myqr.warpImage(background, padded, quad, perspective=True)
+	scene = addNoise(scene, rng.uniform(0, max_noise), rng.getrandbits(32))
+
+	n = padded_modules
+	square = [Point(0, 0), Point(n, 0), Point(n, n), Point(0, n)]
+	homography = perspectiveCoefficients(square, quad)
+	near, far = QUIET_ZONE + 3.5, n - QUIET_ZONE - 3.5
+	truth = [applyHomography(homography, Point(x, y)) for x, y in ((near, near), (far, near), (far, far), (near, far))]
+	return Scene("synthetic-{}mp-{}".format(megapixels, index), scene, payload, truth, module_size)
+
+
+def measureImport(module="myqr", runs=5):
+	'''
+	@params:
+		module is the module to import
+		runs is how many fresh interpreters to time it in
+	returns (seconds, loaded): the fastest import of module in a new interpreter, and
+		which of LAZY_MODULES it loaded along the way
+	'''
+	script = ("import sys, time, json\n"
+		"start = time.perf_counter()\n"
+		"import {}\n"
+		"seconds = time.perf_counter() - start\n"
+		"print(json.dumps([seconds, [m for m in {!r} if m in sys.modules]]))").format(module, LAZY_MODULES)
+	here = os.path.dirname(os.path.abspath(__file__))
+	best = None
+	for i in range(runs):
+		output = subprocess.run([sys.executable, "-c", script], cwd=here, check=True,
+			stdout=subprocess.PIPE, universal_newlines=True).stdout
+		seconds, loaded = json.loads(output)
+		best = seconds if best is None else min(best, seconds)
+	return best, loaded
+
+
+def loadTestImages(directory=TEST_IMAGE_DIR):
+	'''
+	returns a Scene without ground truth for every image in directory
+	'''
+	if not os.path.isdir(directory):
+		return []
+	names = sorted(n for n in os.listdir(directory) if n.lower().endswith((".png", ".jpg", ".jpeg")))
+	return [Scene("TestImages/" + n, Image.open(os.path.join(directory, n)).convert("RGB")) for n in names]
+
+
+def cornerError(pgram, truth):
+	'''
+	@params:
+		pgram is the four points a detector found, in any order
+		truth is the four points it should have found
+	returns (mean, max) distance between matched points, pairing them up the way
+		that makes the total distance smallest
+	'''
+	best = None
+	for order in itertools.permutations(pgram[:4]):
+		errors = [p.distance(q) for p, q in zip(order, truth)]
+		if best is None or sum(errors) < sum(best):
+			best = errors
+	return sum(best) / len(best), max(best)
+
+
+def timeStage(stage, repeat, measure_memory):
+	'''
+	@params:
+		stage is called with no arguments and returns the stage's result
+		repeat is how many timed runs to make
+		measure_memory makes one more run under tracemalloc
+	returns (result, median seconds, peak bytes or None)
+	'''
+	times = []
+	for i in range(repeat):
+		start = time.perf_counter()
+		result = stage()
+		times.append(time.perf_counter() - start)
+	peak = None
+	if measure_memory:
+		tracemalloc.start()
+		stage()
+		peak = tracemalloc.get_traced_memory()[1]
+		tracemalloc.stop()
+	times.sort()
+	return result, times[len(times)//2], peak
+
+
+def benchmarkScene(scene, repeat=3, measure_memory=True, binarize=False):
+	'''
+	runs every stage on scene, feeding each stage the last one's result
+	binarize runs binarizeImage first and detects on its result, named "<scene> binarized"
+	returns a dict of the scene's results, for the JSON report
+	'''
+	width, height = scene.image.size
+	record = {"name": scene.name + (" binarized" if binarize else ""), "size": [width, height],
+		"megapixels": width*height / 1e6, "payload": scene.payload, "module_size": scene.module_size,
+		"binarized": binarize, "stages": {}, "error": None, "corner_error": None, "localized": None}
+	replacement = myqr.makeQRImage("https://example.org/replacement")
+	#Pasting over the same copy every run keeps the copy itself out of the timings
+	canvas = scene.image.copy()
+	stages = (
+		("binarizeImage", lambda: myqr.binarizeImage(scene.image)),
+		("getMassQRClusters", lambda: myqr.getMassQRClusters(detected, 2)),
+		("constructParallelograms", lambda: constructParallelograms(points)),
+		("warpImage", lambda: myqr.warpImage(canvas, replacement, pgram)),
+	)
+	if not binarize:
+		stages = stages[1:]
+	detected = scene.image
+	points = pgram = None
+	for name, stage in stages:
+		try:
+			result, seconds, peak = timeStage(stage, repeat, measure_memory)
+		except Exception as e:
+			record["error"] = "{} at {}: {}".format(type(e).__name__, name, e)
+			break
+		record["stages"][name] = {"seconds": seconds, "images_per_second": 1/seconds if seconds > 0 else None,
+			"peak_bytes": peak}
+		if name == "binarizeImage":
+			detected = result
+		elif name == "getMassQRClusters":
+			points = result
+			record["candidates"] = len(points)
+		elif name == "constructParallelograms":
+			if result is None:
+				record["error"] = "fewer than three finder patterns at {}".format(name)
+				break
+			pgram = result
+			record["parallelogram"] = [p.asTuple() for p in pgram]
+
+	if scene.truth is not None:
+		record["truth"] = [p.asTuple() for p in scene.truth]
+		if pgram is not None:
+			mean, worst = cornerError(pgram, scene.truth)
+			record["corner_error"] = {"mean": mean, "max": worst}
+			record["localized"] = worst <= scene.module_size
+		else:
+			record["localized"] = False
+	return record
+
+
+def summarize(records):
+	'''
+	returns a dict of per stage totals and the localization rate over records
+	'''
+	summary = {"stages": {}}
+	for name in STAGE_NAMES:
+		runs = [r["stages"][name] for r in records if name in r["stages"]]
+		if not runs:
+			continue
+		seconds = sum(run["seconds"] for run in runs)
+		peaks = [run["peak_bytes"] for run in runs if run["peak_bytes"] is not None]
+		summary["stages"][name] = {"images": len(runs), "seconds": seconds,
+			"images_per_second": len(runs)/seconds if seconds > 0 else None,
+			"max_peak_bytes": max(peaks) if peaks else None}
+	for prefix, binarized in (("", False), ("binarized_", True)):
+		graded = [r for r in records if r["localized"] is not None and r.get("binarized", False) == binarized]
+		if binarized and not graded:
+			continue
+		errors = [r["corner_error"]["mean"] for r in graded if r["corner_error"] is not None]
+		summary[prefix + "synthetic"] = len(graded)
+		summary[prefix + "localized"] = sum(1 for r in graded if r["localized"])
+		summary[prefix + "mean_corner_error"] = sum(errors)/len(errors) if errors else None
+	return summary
+
+
+def compareResults(old, new):
+	'''
+	@params:
+		old and new are results dicts as written by main
+	returns a list of lines giving each stage's time in new relative to old, scene by scene
+	'''
+	before = {r["name"]: r for r in old["scenes"]}
+	lines = []
+	for record in new["scenes"]:
+		previous = before.get(record["name"])
+		if previous is None:
+			continue
+		for name in STAGE_NAMES:
+			if name in record["stages"] and name in previous["stages"]:
+				was, now = previous["stages"][name]["seconds"], record["stages"][name]["seconds"]
+				lines.append("{:<32} {:<24} {:9.4f}s -> {:9.4f}s  x{:.2f}".format(
+					record["name"], name, was, now, was/now if now > 0 else float("inf")))
+	return lines
+
+
+def main(argv=None):
+	parser = argparse.ArgumentParser(description="Benchmark QR detection and warping.")
+	parser.add_argument("--sizes", type=float, nargs="*", default=list(SCENE_SIZES),
+		help="synthetic scene sizes in megapixels")
+	parser.add_argument("--per-size", type=int, default=2, help="synthetic scenes of each size")
+	parser.add_argument("--seed", type=int, default=0, help="seed for the synthetic scenes")
+	parser.add_argument("--repeat", type=int, default=3, help="timed runs of each stage")
+	parser.add_argument("--no-memory", action="store_true", help="skip the tracemalloc runs")
+	parser.add_argument("--no-test-images", action="store_true", help="skip the images in TestImages")
+	parser.add_argument("--binarize", action="store_true",
+		help="also benchmark every scene with binarizeImage run before detection")
+	parser.add_argument("--output", help="write the results as JSON to this file")
+	parser.add_argument("--compare", help="an earlier results file to compare stage times against")
+	parser.add_argument("--check-imports", action="store_true",
+		help="only check the cold import time of myqr against --import-budget")
+	parser.add_argument("--import-budget", type=float, default=IMPORT_BUDGET,
+		help="seconds a cold import of myqr may take")
+	args = parser.parse_args(argv)
+
+	import_seconds, loaded = measureImport()
+	print("import myqr {:.3f}s (budget {:.3f}s){}".format(import_seconds, args.import_budget,
+		", loaded " + ", ".join(loaded) if loaded else ""))
+	if args.check_imports:
+		return 1 if loaded or import_seconds > args.import_budget else 0
+
+	def scenes():
+		if not args.no_test_images:
+			yield from loadTestImages()
+		for megapixels in args.sizes:
+			for index in range(args.per_size):
+				yield makeScene(megapixels, index, args.seed)
+
+	records = []
+	for scene in scenes():
+		for binarize in (False, True) if args.binarize else (False,):
+			record = benchmarkScene(scene, args.repeat, not args.no_memory, binarize)
+			records.append(record)
+			timings = "  ".join("{} {:.3f}s".format(name, run["seconds"]) for name, run in record["stages"].items())
+			status = record["error"] or ("" if record["corner_error"] is None else
+				"corner error {:.2f}px".format(record["corner_error"]["mean"]))
+			print("{:<32} {}  {}".format(record["name"], timings, status))
+			sys.stdout.flush()
+
+	results = {"meta": {"python": platform.python_version(), "numpy": np.__version__,
+		"platform": platform.platform(), "time": time.strftime("%Y-%m-%dT%H:%M:%S"), "args": vars(args),
+		"import_seconds": import_seconds, "import_loaded": loaded},
+		"scenes": records, "summary": summarize(records)}
+	summary = results["summary"]
+	for name, stage in summary["stages"].items():
+		print("{:<24} {:.2f} images/s over {} images".format(name, stage["images_per_second"] or 0, stage["images"]))
+	print("{} of {} synthetic scenes localized to within a module".format(summary["localized"], summary["synthetic"]))
+	if "binarized_synthetic" in summary:
+		print("{} of {} localized after binarizing".format(summary["binarized_localized"], summary["binarized_synthetic"]))
+
+	if args.output:
+		with open(args.output, "w") as output:
+			json.dump(results, output, indent=1)
+	if args.compare:
+		with open(args.compare) as baseline:
+			for line in compareResults(json.load(baseline), results):
+				print(line)
+	return 0
+
+
+if __name__ == "__main__":
+	sys.exit(main())
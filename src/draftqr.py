@@ -0,0 +1,139 @@
+#!/usr/bin/env python3
+import math
+import os
+from PIL import Image, JpegImagePlugin
+from mathutil import *
+from mathobjects import *
+import myqr
+import streamqr
+
+'''
+Finding QR codes in big JPEGs without decoding them at full size first.
+
+Usage:
+	pgram = scanImageFile("photo.jpg")
+	insertQRFile("photo.jpg", "https://example.com", "out.jpg")
+
+NOTE:
+JPEG can decode straight to 1/2, 1/4 or 1/8 of its size (PIL's Image.draft), for a
+fraction of the cost of a full decode. The code is looked for in that draft, and the
+finder centers found there are scaled back up. They are only as precise as a draft
+pixel, so when the full image is decoded anyway (to composite into it), a window around
+each center is rescanned at full size to place it exactly, as in streamqr.
+
+other formats have no reduced decode, they are opened whole and scanned as usual.
+'''
+
+#Draft decodes are this many times smaller than the image, at most
+DRAFT_SCALE = 4
+
+
+def openDraft(path, scale=DRAFT_SCALE):
+	'''
+	@params:
+		path is the image file to open
+		scale is how many times smaller to decode it, if the format allows
+	returns (image, (sx, sy)): the decoded RGB image, and how many full size pixels
+		each of its pixels covers along x and y. JPEG decoders only scale by powers of
+		two up to 8, so the draft may be a little larger than asked for.
+	'''
+	image = Image.open(path)
+	width, height = image.size
+	if scale > 1 and image.format == "JPEG":
+		image.draft("RGB", (max(width // scale, 1), max(height // scale, 1)))
+	image = image.convert("RGB")
+	return image, (width / image.size[0], height / image.size[1])
+
+
+def findDraftCenters(path, scale=DRAFT_SCALE, binarize=False):
+	'''
+	@params:
+		path is the image file to search
+		scale is the most the draft is shrunk by. If no code turns up, the draft is
+			decoded again at twice the size, down to the full image.
+		binarize scans a thresholded draft, as in myqr.scanImage2
+	returns (centers, module_size, factor): the three finder centers and module size, in
+		full size pixels, and the factor the draft they were found on was shrunk by,
+		or (None, None, None) if there is no code to be found
+	'''
+	tracker = streamqr.QRTracker()
+	while True:
+		draft, (sx, sy) = openDraft(path, scale)
+		if binarize:
+			draft = myqr.binarizeImage(draft)
+		centers, module_size = tracker.findCenters(draft)
+		if centers is not None:
+			#Draft pixel x covers full size pixels x*sx up to (x+1)*sx
+			centers = [Point((p.x + 0.5)*sx - 0.5, (p.y + 0.5)*sy - 0.5) for p in centers]
+			return centers, module_size * max(sx, sy), max(sx, sy)
+		if scale <= 1 or (sx <= 1 and sy <= 1):
+			return None, None, None
+		scale //= 2
+
+
+def refineCenters(image, centers, module_size, factor, binarize=False):
+	'''
+	@params:
+		image is the full size image
+		centers, module_size and factor are as from findDraftCenters
+		binarize is as in findDraftCenters
+	returns the centers placed exactly by rescanning a window around each on image,
+		or the centers unchanged if a rescan loses one
+	'''
+	if factor <= 1:
+		return centers
+	tracker = streamqr.QRTracker(search_modules=max(2, int(math.ceil(factor / module_size)) + 1))
+	tracker.centers = centers
+	tracker.module_size = module_size
+	if binarize:
+		image = myqr.binarizeImage(image)
+	refined, refined_module = tracker.trackCenters(image)
+	return refined if refined is not None else centers
+
+
+def scanImageFile(path, scale=DRAFT_SCALE, refine=False, binarize=False):
+	'''
+	@params:
+		path is the image file to search
+		scale and binarize are as in findDraftCenters
+		refine decodes the image at full size to place the centers exactly
+	returns the parallelogram around the QR code in path, like myqr.scanImage2,
+		or None if there is none
+	'''
+	centers, module_size, factor = findDraftCenters(path, scale, binarize)
+	if centers is None:
+		return None
+	if refine:
+		centers = refineCenters(Image.open(path).convert("RGB"), centers, module_size, factor, binarize)
+	return extrapolateParallelogram(*centers)
+
+
+def insertQRFile(path, data, output_path, scale=DRAFT_SCALE, perspective=False, binarize=False):
+	'''
+	@params:
+		path is the image file to change
+		data is what will be encoded in the QR code
+		output_path is where to save the result
+		scale and binarize are as in findDraftCenters
+		perspective is passed on to myqr.warpImage
+	Like myqr.insertQR on a file, finding the code on a draft and decoding the full
+		image only for the refinement and the composite. A JPEG saved as a JPEG keeps
+		the original's quantization tables and subsampling, so the blocks the code
+		doesn't touch come out close to how they went in.
+	returns the parallelogram the code went into, or None if no code was found
+	'''
+	centers, module_size, factor = findDraftCenters(path, scale, binarize)
+	if centers is None:
+		return None
+	original = Image.open(path)
+	image = original.convert("RGB")
+	pgram = extrapolateParallelogram(*refineCenters(image, centers, module_size, factor, binarize))
+	image = myqr.warpImage(image, myqr.makeQRImage(data), pgram, perspective)
+
+	if original.format == "JPEG" and os.path.splitext(output_path)[1].lower() in (".jpg", ".jpeg"):
+		#quality="keep" only works on the opened JPEG itself, so hand its tables over directly
+		image.save(output_path, format="JPEG", qtables=original.quantization,
+			subsampling=JpegImagePlugin.get_sampling(original))
+	else:
+		image.save(output_path)
+	return pgram
@@ -1,11 +1,14 @@
 #!/usr/bin/env python3
 import mathutil
 import math
+import numpy as np
 
 class Point:
 	'''
 	its a point
 	'''
+	__slots__ = ("x", "y") #the scanner makes a lot of these, keep them small
+
 	def __init__(self,x,y):
 		self.x = x
 		self.y = y
@@ -112,3 +115,132 @@ class Segment:
 
 	def midpoint(self):
 		return 0.5 * (self.p1 + self.p2)
+
+
+class PointArray:
+	'''
+	Many points at once, stored as an (n,2) float array of (x,y) rows.
+	Behaves like a list of Points when iterated or indexed with an int, and like
+	one Point when doing math, with every operation applied to all points at once.
+	'''
+	def __init__(self, xy):
+		self.xy = np.asarray(xy, dtype=np.float64).reshape(-1, 2)
+
+	@classmethod
+	def fromPoints(cls, points):
+		'''
+		returns a PointArray holding points, an iterable of Points
+		'''
+		return cls([p.asTuple() for p in points])
+
+	@classmethod
+	def concatenate(cls, arrays):
+		'''
+		returns one PointArray holding all the points of arrays, in order
+		'''
+		return cls(np.concatenate([a.xy for a in arrays]) if arrays else [])
+
+	@property
+	def x(self):
+		return self.xy[:, 0]
+
+	@property
+	def y(self):
+		return self.xy[:, 1]
+
+	def __len__(self):
+		return len(self.xy)
+
+	def __getitem__(self, index):
+		if isinstance(index, (int, np.integer)):
+			return Point(*self.xy[index].tolist())
+		return PointArray(self.xy[index])
+
+	def __iter__(self):
+		return (Point(x, y) for x, y in self.xy.tolist())
+
+	def __array__(self, dtype=None, copy=None):
+		return self.xy if dtype is None else self.xy.astype(dtype)
+
+	def __str__(self):
+		return "[{}]".format(", ".join(str(p) for p in self))
+
+	def __repr__(self):
+		return str(self)
+
+	def asTuples(self):
+		return [tuple(p) for p in self.xy.tolist()]
+
+	def _coords(self, other):
+		#Points, PointArrays and (x,y) tuples can all be added and subtracted
+		if isinstance(other, PointArray):
+			return other.xy
+		if isinstance(other, Point):
+			return np.array(other.asTuple(), dtype=np.float64)
+		return np.asarray(other, dtype=np.float64)
+
+	def __add__(self, other): #Add with another point or points
+		return PointArray(self.xy + self._coords(other))
+
+	def __sub__(self, other):
+		return PointArray(self.xy - self._coords(other))
+
+	def __rmul__(self, other): #Multiply by scalar number
+		return PointArray(self.xy * other)
+
+	def distance(self, other):
+		'''
+		returns an array of the distance from each point to other, a Point or PointArray
+		'''
+		return np.hypot(*(self.xy - self._coords(other)).T)
+
+	def angleOf(self):
+		'''
+		returns an array of each point's counter-clockwise rotation from the x axis,
+			in [0,2pi), as Point.angleOf
+		'''
+		at = np.arctan2(self.xy[:, 1], self.xy[:, 0])
+		return np.where(at < 0, at + 2*math.pi, at)
+
+	def isInBounds(self, image):
+		'''
+		returns a boolean array, True for each point inside image
+		'''
+		width, height = image.size
+		x = self.xy[:, 0]
+		y = self.xy[:, 1]
+		return (x >= 0) & (y >= 0) & (x < width) & (y < height)
+
+
+class SegmentArray:
+	'''
+	Many segments at once, as two PointArrays of the same length holding their ends
+	'''
+	def __init__(self, p1, p2):
+		self.p1 = p1 if isinstance(p1, PointArray) else PointArray(p1)
+		self.p2 = p2 if isinstance(p2, PointArray) else PointArray(p2)
+
+	@classmethod
+	def fromSegments(cls, segments):
+		'''
+		returns a SegmentArray holding segments, an iterable of Segments
+		'''
+		segments = list(segments)
+		return cls(PointArray.fromPoints(s.p1 for s in segments), PointArray.fromPoints(s.p2 for s in segments))
+
+	def __len__(self):
+		return len(self.p1)
+
+	def __getitem__(self, index):
+		if isinstance(index, (int, np.integer)):
+			return Segment(self.p1[index], self.p2[index])
+		return SegmentArray(self.p1[index], self.p2[index])
+
+	def __iter__(self):
+		return (Segment(a, b) for a, b in zip(self.p1, self.p2))
+
+	def length(self):
+		return self.p1.distance(self.p2)
+
+	def midpoint(self):
+		return 0.5 * (self.p1 + self.p2)
@@ -1,6 +1,13 @@
 import math
-from sklearn.cluster import AffinityPropagation
+import itertools
+import numpy as np
 from mathobjects import *
+import qrtrace
+
+#Candidates above this are pre-aggregated down to the heaviest whole-pixel bins before clustering
+MAX_CLUSTER_POINTS = 100000
+#A QR code is 21 to 177 modules wide, so its finder centers are 14 to 170 modules apart
+FINDER_SPACING = (14, 170)
 
 def clockwiseRotation(from_v, to_v):
 	'''
@@ -66,6 +73,24 @@ def insertQR(image, bounds, data):
 	'''
 	pass #@todo(someone) implement this
 
+def perspectiveCoefficients(from_quad, to_quad):
+	'''
+	@params:
+		from_quad is four points
+		to_quad is the four points they map to, in the same order
+	returns the 8 coefficients (a,b,c,d,e,f,g,h) of the homography taking each point of
+		from_quad to the matching point of to_quad, where (x,y) maps to
+		((a*x + b*y + c)/(g*x + h*y + 1), (d*x + e*y + f)/(g*x + h*y + 1)).
+		This is the form PIL's Image.PERSPECTIVE transform takes.
+	'''
+	rows = []
+	targets = []
+	for p, q in zip(from_quad, to_quad):
+		rows.append([p.x, p.y, 1, 0, 0, 0, -q.x*p.x, -q.x*p.y])
+		rows.append([0, 0, 0, p.x, p.y, 1, -q.y*p.x, -q.y*p.y])
+		targets += [q.x, q.y]
+	return tuple(np.linalg.solve(np.array(rows, dtype=np.float64), np.array(targets, dtype=np.float64)).tolist())
+
 def extrapolateParallelogram(a, b, c):
 	'''
 	@params:
@@ -143,20 +168,363 @@ def expandParallelogram(parallelogram, amount):
 
 	return (UL, UR, LR, LL)
 
-def constructParallelograms(dataset):
+def aggregatePoints(points, max_points=MAX_CLUSTER_POINTS):
+	'''
+	@params:
+		points is a list of point-tuples or an (n,2) array
+		max_points is the most bins to keep, None to keep them all
+	returns (bins, weights): the whole-pixel bins points fall into, as an (m,2) array
+		of the mean point in each bin, and how many points fell into each.
+		If there are more than max_points bins only the heaviest are kept.
+	'''
+	points = np.asarray(points, dtype=np.float64).reshape(-1, 2)
+	if len(points) == 0:
+		return points, np.empty(0)
+	pixels, inverse, weights = np.unique(np.floor(points).astype(np.int64), axis=0,
+		return_inverse=True, return_counts=True)
+	inverse = inverse.reshape(-1)
+	bins = np.stack([np.bincount(inverse, points[:, i]) for i in (0, 1)], axis=1) / weights[:, np.newaxis]
+	if max_points is not None and len(bins) > max_points:
+		heaviest = np.argpartition(-weights, max_points)[:max_points]
+		bins = bins[heaviest]
+		weights = weights[heaviest]
+	return bins, weights.astype(np.float64)
+
+def clusterLabels(points, radius, weights=None, density=2):
+	'''
+	@params:
+		points is an (n,2) array of points
+		radius is the size of the grid cells points are bucketed into
+		weights is how much each point counts for, 1 each if not given
+		density is how many times the average weight per cell, over the box the points
+			span, a cell needs to join up with its neighbours
+	returns an array giving the cluster number of each point, numbered from 0.
+		Points are bucketed into radius-sized grid cells and cells touching each other
+		(including diagonally) are joined into one cluster, so the cost grows with the
+		number of points, not its square. Cells lighter than density allows, such as
+		ones holding only stray candidates in a noisy image, only join the heaviest
+		cluster they touch, so a trail of them can never chain two clusters into one.
+		When the points are sparse, or no cell stands out from the rest, every cell is
+		dense enough and this is plain single linkage.
+	'''
+	cells = np.floor(points / radius).astype(np.int64)
+	cells -= cells.min(axis=0) - 1 #leave an empty border so neighbours never go negative
+	stride = cells[:, 1].max() + 2
+	#np.unique sorts, so keys come out sorted and neighbours can be found by binary search
+	keys, inverse = np.unique(cells[:, 0]*stride + cells[:, 1], return_inverse=True)
+	inverse = inverse.reshape(-1)
+	cell_weights = np.bincount(inverse, weights, minlength=len(keys))
+	average = cell_weights.sum() / np.prod(np.ptp(cells, axis=0) + 1.0)
+	#Points that fill their own box, like one finder's candidates in a window, have no
+	#background to stand out from, so a cell a quarter as heavy as the heaviest will do
+	dense = cell_weights >= min(density*average, cell_weights.max() / 4)
+
+	#Link each occupied cell to its occupied neighbours
+	ends_a = []
+	ends_b = []
+	for dx, dy in ((1, -1), (1, 0), (1, 1), (0, 1)):
+		neighbours = keys + dx*stride + dy
+		found = np.minimum(np.searchsorted(keys, neighbours), len(keys) - 1)
+		linked = (keys[found] == neighbours) & dense & dense[found]
+		ends_a.append(np.flatnonzero(linked))
+		ends_b.append(found[linked])
+	ends_a = np.concatenate(ends_a)
+	ends_b = np.concatenate(ends_b)
+
+	#Spread the lowest label over each group of linked cells
+	labels = np.arange(len(keys))
+	while len(ends_a):
+		previous = labels
+		low = np.minimum(labels[ends_a], labels[ends_b])
+		labels = labels.copy()
+		np.minimum.at(labels, ends_a, low)
+		np.minimum.at(labels, ends_b, low)
+		labels = labels[labels] #jump straight to the label's own label
+		if np.array_equal(labels, previous):
+			break
+
+	#Hang each light cell on its heaviest dense neighbour, if it has one
+	group_weights = np.bincount(labels, cell_weights, minlength=len(keys))
+	best = np.full(len(keys), -1)
+	best_weight = np.zeros(len(keys))
+	for dx in (-1, 0, 1):
+		for dy in (-1, 0, 1):
+			neighbours = keys + dx*stride + dy
+			found = np.minimum(np.searchsorted(keys, neighbours), len(keys) - 1)
+			touching = (keys[found] == neighbours) & dense[found] & ~dense
+			heavier = touching & (group_weights[labels[found]] > best_weight)
+			best[heavier] = labels[found[heavier]]
+			best_weight[heavier] = group_weights[labels[found[heavier]]]
+	labels = np.where(best >= 0, best, labels)
+
+	groups, members = np.unique(labels[inverse], return_inverse=True)
+	return members.reshape(-1)
+
+@qrtrace.traced()
+def clusterPoints(points, radius, weights=None):
+	'''
+	@params:
+		points is an (n,2) array of points
+		radius is the size of the grid cells points are bucketed into
+		weights is how much each point counts for, 1 each if not given
+	returns a list of cluster-tuples ((x,y), weight), heaviest first, clustered as in
+		clusterLabels. The point-tuple is the weighted mean.
+	'''
+	points = np.asarray(points, dtype=np.float64).reshape(-1, 2)
+	if weights is None:
+		weights = np.ones(len(points))
+	if len(points) == 0:
+		return []
+
+	members = clusterLabels(points, radius, weights)
+	totals = np.bincount(members, weights)
+	xs = (np.bincount(members, weights*points[:, 0]) / totals).tolist()
+	ys = (np.bincount(members, weights*points[:, 1]) / totals).tolist()
+	order = np.argsort(-totals, kind="stable")
+	totals = totals.tolist()
+	return [((xs[i], ys[i]), totals[i]) for i in order.tolist()]
+
+def weightedQuantile(values, weights, q):
+	'''
+	returns the value below which a fraction q of the total weight of values lies
+	'''
+	order = np.argsort(values, kind="stable")
+	cumulative = np.cumsum(weights[order])
+	return values[order][min(np.searchsorted(cumulative, q*cumulative[-1]), len(values) - 1)]
+
+def estimateModuleSize(points, weights=None, tail=.02):
+	'''
+	@params:
+		points is an (n,2) array of finder candidates, at most one per pixel as from
+			aggregatePoints
+		weights is how much each point counts for
+		tail is the fraction of the weight near the clump that is let off at each end
+			when measuring it, so a few stray candidates can't stretch it
+	returns the estimated size of one QR module in pixels.
+		Neighbouring scanlines put the candidates of one finder pattern next to each other,
+		all over its 3 module wide center, so the clump covering the most pixels is ~3 modules
+		across. Its neighbourhood grows with the pixels it covers rather than its weight,
+		since scans stacking many candidates on a few pixels say nothing about its size.
+	'''
+	points = np.asarray(points, dtype=np.float64).reshape(-1, 2)
+	if len(points) == 0:
+		return 1.0
+	weights = np.ones(len(points)) if weights is None else np.asarray(weights, dtype=np.float64)
+	members = clusterLabels(points, 2, weights)
+	clump = members == np.argmax(np.bincount(members))
+	center = np.average(points[clump], axis=0, weights=weights[clump])
+	covered = len(np.unique(np.floor(points[clump]).astype(np.int64), axis=0))
+
+	#Robust extent: the spread of the weight closest to the clump, less the tails
+	near = np.hypot(*(points - center).T) < 2*math.sqrt(covered) + 2
+	if near.sum() < 2:
+		return 1.0
+	extent = max(weightedQuantile(points[near, i], weights[near], 1 - tail) -
+		weightedQuantile(points[near, i], weights[near], tail) for i in (0, 1))
+	return max(extent / 3, 1.0)
+
+def finderClusters(dataset, module_size=None, max_points=MAX_CLUSTER_POINTS):
+	'''
+	@params:
+		dataset is a list of finder candidates, as in constructParallelograms
+		module_size sets the clustering radius as in constructParallelograms
+		max_points is as in aggregatePoints
+	returns (centers, weights, extents), heaviest first: an (m,2) array of finder pattern
+		centers, how many candidates each has, and the (m,2) width and height of each
+		cluster. The candidates of one finder pattern cover its 3 module wide center, so
+		a cluster's extent is about 3 of that pattern's modules.
+	'''
+	points, weights = aggregatePoints(dataset, max_points)
+	if len(points) == 0:
+		return np.empty((0, 2)), np.empty(0), np.empty((0, 2))
+	if module_size is None:
+		module_size = estimateModuleSize(points, weights)
+	members = clusterLabels(points, max(1.5*module_size, 2), weights)
+	totals = np.bincount(members, weights)
+	centers = np.stack([np.bincount(members, weights*points[:, i]) for i in (0, 1)], axis=1) / totals[:, np.newaxis]
+	low = np.full((len(totals), 2), np.inf)
+	high = np.full((len(totals), 2), -np.inf)
+	np.minimum.at(low, members, points)
+	np.maximum.at(high, members, points)
+	order = np.argsort(-totals, kind="stable")
+	return centers[order], totals[order], (high - low)[order]
+
+def nearestNeighbours(points, k):
+	'''
+	@params:
+		points is an (n,2) array of points
+		k is how many neighbours to find for each point
+	returns an (n, min(k, n-1)) array of the indices of each point's nearest other points,
+		nearest first. Points are bucketed into a grid of about one point per cell, and
+		rings of cells are searched outward from each point until no unsearched cell
+		could hold anything nearer, so the cost stays near linear in n.
+	'''
+	points = np.asarray(points, dtype=np.float64).reshape(-1, 2)
+	n = len(points)
+	k = min(k, n - 1)
+	if k <= 0:
+		return np.empty((n, 0), dtype=np.int64)
+	low = points.min(axis=0)
+	cell = max(np.ptp(points, axis=0).max() / math.sqrt(n), 1e-9)
+	cells = np.floor((points - low) / cell).astype(np.int64).tolist()
+	buckets = {}
+	for i, key in enumerate(cells):
+		buckets.setdefault(tuple(key), []).append(i)
+
+	result = np.empty((n, k), dtype=np.int64)
+	for i, (cx, cy) in enumerate(cells):
+		found = list(buckets[(cx, cy)])
+		ring = 0
+		while True:
+			if len(found) > k:
+				distances = np.hypot(*(points[found] - points[i]).T)
+				nearest = np.argsort(distances, kind="stable")
+				#Anything not found yet is at least ring cells away
+				if distances[nearest[k]] <= ring*cell:
+					break
+			ring += 1
+			for dx in range(-ring, ring + 1):
+				for dy in ((-ring, ring) if abs(dx) != ring else range(-ring, ring + 1)):
+					found += buckets.get((cx + dx, cy + dy), ())
+		found = np.array(found)[nearest]
+		result[i] = found[found != i][:k]
+	return result
+
+def plausibleParallelogram(parallelogram, max_aspect=2, min_sine=.5):
+	'''
+	@params:
+		parallelogram is four points going around it, as from constructParallelograms
+		max_aspect is how many times longer one side may be than the next
+		min_sine is the smallest sine of a corner angle allowed, .5 is 30 degrees off square
+	returns true if parallelogram is square enough to be a QR code, even one seen at an
+		angle. Three clusters that aren't all finder patterns rarely are.
+	'''
+	corner, right, left = parallelogram[0], parallelogram[1], parallelogram[3]
+	leg_a = right - corner
+	leg_b = left - corner
+	length_a = leg_a.distance(Point(0, 0))
+	length_b = leg_b.distance(Point(0, 0))
+	if min(length_a, length_b) == 0 or max(length_a, length_b) > max_aspect*min(length_a, length_b):
+		return False
+	return abs(leg_a.x*leg_b.y - leg_a.y*leg_b.x) >= min_sine*length_a*length_b
+
+def groupFinders(centers, module_sizes, neighbours=12, angle_tolerance=math.radians(25),
+		side_tolerance=.3, size_tolerance=.3):
+	'''
+	@params:
+		centers is an (m,2) array of finder pattern centers
+		module_sizes is each center's module size
+		neighbours is how many of each center's nearest centers may be its legs
+		angle_tolerance is how far from a right angle the corner may be, in radians
+		side_tolerance is how much longer one leg may be than the other, as a fraction
+		size_tolerance is how much the three patterns' module sizes may differ, as a fraction
+	returns a list of (corner, upper right, lower left) index triplets, one per QR code.
+		Only each center's nearest neighbours are tried as its legs, so this is linear in
+		the number of centers. Every triplet that passes the checks is scored by how far it
+		is from a perfect code, and the best are taken first, each center used only once.
+	'''
+	if len(centers) < 3:
+		return []
+	near = nearestNeighbours(centers, neighbours)
+	points = [Point(x, y) for x, y in centers.tolist()]
+	low, high = FINDER_SPACING
+	triplets = []
+	for corner, legs in enumerate(near.tolist()):
+		size = module_sizes[corner]
+		legs = [leg for leg in legs if abs(module_sizes[leg]/size - 1) <= size_tolerance]
+		for a, b in itertools.combinations(legs, 2):
+			leg_a = points[a] - points[corner]
+			leg_b = points[b] - points[corner]
+			length_a = leg_a.distance(Point(0, 0))
+			length_b = leg_b.distance(Point(0, 0))
+			if not (low*(1 - side_tolerance) <= length_a/size <= high*(1 + side_tolerance)):
+				continue
+			if length_b == 0 or abs(length_a/length_b - 1) > side_tolerance:
+				continue
+			#Going clockwise as the code is read, the lower left leg comes a quarter turn before the upper right
+			turn = clockwiseRotation(leg_a, leg_b)
+			if abs(turn - math.pi/2) <= angle_tolerance:
+				upper_right, lower_left = b, a
+			elif abs(turn - 3*math.pi/2) <= angle_tolerance:
+				upper_right, lower_left = a, b
+				turn = 2*math.pi - turn
+			else:
+				continue
+			score = (abs(turn - math.pi/2)/angle_tolerance + abs(length_a/length_b - 1)/side_tolerance +
+				(abs(module_sizes[a]/size - 1) + abs(module_sizes[b]/size - 1))/size_tolerance)
+			#Finders of neighbouring codes can square up too, but a code's own are nearer each other
+			triplets.append((score, length_a + length_b, corner, upper_right, lower_left))
+
+	triplets.sort()
+	used = set()
+	codes = []
+	for score, length, corner, upper_right, lower_left in triplets:
+		if corner in used or upper_right in used or lower_left in used:
+			continue
+		used.update((corner, upper_right, lower_left))
+		codes.append((corner, upper_right, lower_left))
+	return codes
+
+@qrtrace.traced()
+def findParallelograms(dataset, module_size=None, max_points=MAX_CLUSTER_POINTS, min_weight=3):
+	'''
+	@params
+		dataset, module_size and max_points are as in constructParallelograms. dataset has
+			to come from scans in at least two directions (see below).
+		min_weight is how many candidates a finder pattern needs, fewer is taken for noise
+	A finder pattern matches the ratio across every direction, so scans in two directions
+		leave a cross of candidates. Runs in the data that happen to match leave a line,
+		and clusters much thinner one way than the other are dropped.
+	returns a list of the parallelograms around every QR code found, top to bottom then
+		left to right. Each starts at the code's upper left finder pattern and goes
+		clockwise as the code is read, so a code warped onto it comes out the right way up.
+	'''
+	centers, weights, extents = finderClusters(dataset, module_size, max_points)
+	thin, wide = extents.min(axis=1), extents.max(axis=1)
+	kept = (weights >= min_weight) & (thin >= np.maximum(wide/4, 1))
+	centers = centers[kept]
+	#Stray candidates next to a pattern can only stretch its cluster, so go by the thin side
+	modules = np.maximum(thin[kept] / 3, 1.0)
+	qrtrace.count("clusters", len(centers))
+	parallelograms = []
+	for corner, upper_right, lower_left in groupFinders(centers, modules):
+		a, b, c = [Point(x, y) for x, y in centers[[corner, upper_right, lower_left]].tolist()]
+		parallelograms.append((a, b, b + c - a, c))
+	parallelograms.sort(key=lambda pgram: (min(p.y for p in pgram), min(p.x for p in pgram)))
+	return parallelograms
+
+@qrtrace.traced()
+def constructParallelograms(dataset, module_size=None, max_points=MAX_CLUSTER_POINTS, method="grid"):
 	'''
 	@params
 		dataset is a list of points to find clusters in
-	returns a list of the parallelograms found.
-	'''
-	af = AffinityPropagation().fit(dataset)
-	print(af.cluster_centers_, af.labels_, len(af.cluster_centers_))
-	clusters = []
-	count = 0
-	while (count < len(af.cluster_centers_)):
-		pointlist = af.cluster_centers_[count].tolist()
-		clusters += [Point(pointlist[0], pointlist[1])]
-		count += 1
-
-	print(clusters)
+		module_size is the size of a QR module in pixels, estimated from dataset if not given.
+			Candidates within 1.5 modules of each other belong to one finder pattern.
+		max_points caps how many candidates are clustered, see aggregatePoints
+		method is "grid" for clusterPoints, or "affinity" for sklearn's AffinityPropagation
+			(quadratic in the number of candidates, kept for comparison), or a function
+			taking the same arguments as clusterPoints, such as a qrbackends engine's cluster
+	returns the parallelogram through the three heaviest finder patterns, or None if
+		fewer than three are found.
+	'''
+	if method == "affinity":
+		from sklearn.cluster import AffinityPropagation #slow to import, and only needed here
+		af = AffinityPropagation().fit(np.asarray(dataset))
+		clusters = []
+		count = 0
+		while (count < len(af.cluster_centers_)):
+			pointlist = af.cluster_centers_[count].tolist()
+			clusters += [Point(pointlist[0], pointlist[1])]
+			count += 1
+	else:
+		points, weights = aggregatePoints(dataset, max_points)
+		if module_size is None:
+			module_size = estimateModuleSize(points, weights)
+		cluster = method if callable(method) else clusterPoints
+		found = cluster(points, max(1.5*module_size, 2), weights)
+		clusters = [Point(x, y) for (x, y), size in found]
+
+	qrtrace.count("clusters", len(clusters))
+	if len(clusters) < 3:
+		return None
 	return extrapolateParallelogram(clusters[0], clusters[1], clusters[2])
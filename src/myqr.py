@@ -1,12 +1,17 @@
 #!/usr/bin/env python3
 from PIL import Image
+import hashlib
 import math
-import qrcode
 import numpy as np
 from numpy.linalg import inv
 import itertools
 from mathutil import *
 from mathobjects import *
+from scanlines import *
+from qrcache import LRUCache
+import qrbackends
+import qrconfig
+import qrtrace
 
 '''
 NOTE:
@@ -20,6 +25,29 @@ cluster-tuple is a (point-tuple, int) where the int is cluster size
 quadrilateral-tuples are 4 element tuples structured as (point-tuple,point-tuple,point-tuple,point-tuple)
 '''
 
+#Rendered QR codes, keyed by (data, version, box_size, error_correction)
+QR_IMAGE_CACHE = LRUCache(64)
+#Warped paste masks, keyed by (code size, target box size, transform, coefficients)
+WARP_MASK_CACHE = LRUCache(16)
+#qrcode.constants.ERROR_CORRECT_M, so the default doesn't need qrcode imported
+ERROR_CORRECT_M = 0
+#Part of every detection cache key, bump it when a change moves detection results
+DETECTION_VERSION = 3
+#Default of the detection arguments a config also holds, so passing any value at all,
+#even the balanced preset's, can be told apart from leaving it to the config
+_UNSET = object()
+#The diffColors value two neighbouring pixels must exceed to split a run
+COLOR_THRESHOLD = 50
+#How light getPyramidQRClusters' third finder may be next to its first, as a fraction
+PYRAMID_MIN_WEIGHT_RATIO = .5
+#How much longer one of getPyramidQRClusters' finder spacings may be than the other, as a fraction
+PYRAMID_SIDE_TOLERANCE = .2
+#How many modules crossCheckFinder may move a finder center before it is taken for a look-alike
+PYRAMID_MAX_SHIFT = 1.5
+#The least getPyramidQRClusters shrinks by. A 1/2 copy costs a quarter of a full scan before
+#the rescans, so past 1/4 the full scan is as cheap.
+PYRAMID_MIN_SCALE = 4
+
 
 def diffColors(a, b):
 	'''
@@ -61,7 +89,15 @@ def getColorGroups(image, start, direction):
 
 	direction as a vector allows this function to be used for vertical, horizontal,
 	diagonal, or any angle of traversal, at varying levels of precision.
+
+	If image is a ScanGrid and direction is axis-aligned, the Segments are read off the
+	grid's precomputed breaks instead of walking pixel by pixel.
 	'''
+	if isinstance(image, ScanGrid):
+		axis = axisDirection(direction)
+		if axis is not None and image.isLatticePoint(start):
+			return image.colorGroups(start, axis)
+
 	ret_vals = [] #Create list to add clusters to
 	last_point = start
 	next_point = last_point + direction
@@ -69,7 +105,7 @@ def getColorGroups(image, start, direction):
 	#Track current cluster
 	cluster_start = last_point
 
-	threshold = 50
+	threshold = image.threshold if isinstance(image, ScanGrid) else COLOR_THRESHOLD
 	#Continue scanning until curr_point is outside of image
 	while next_point.isInBounds(image):
 		delta = diffPoints(image, last_point, next_point)
@@ -89,74 +125,253 @@ def getColorGroups(image, start, direction):
 	return ret_vals
 
 
-def findQR(image):
+@qrtrace.traced()
+def findQR(image, workers=None, pyramid_levels=_UNSET, binarize=_UNSET, min_module=_UNSET, cache=None,
+		backend=None, config=None):
 	'''
 	@params:
 		image is the image that we'll be messing with
-	Returns n quadrilateral-tuples where n is the number of QR codes in the image.
+		workers, pyramid_levels, binarize, min_module, cache, backend and config are as
+			in scanImage2. The config's gather, orient and max_regions are not used.
+	Returns n quadrilateral-tuples where n is the number of QR codes in the image,
+		as from findParallelograms, keeping those checkFinderLayout confirms.
+		Scans in gather mode, since findParallelograms needs scanlines along both axes.
 	'''
-	clusters = getPixelClusters(image)
-	pass #@todo(someone) finish this
+	config = detectionConfig(config, pyramid_levels=pyramid_levels, binarize=binarize, min_module=min_module)
+	if cache is not None:
+		key = detectionKey(image, "findQR", **dict(config.key()))
+		found = cachedDetection(cache, key, config, lambda deadline: [[p.asTuple() for p in pgram]
+			for pgram in _findQR(image, workers, backend, config, deadline)])
+		return [tuple(Point(x, y) for x, y in pgram) for pgram in found]
+	return _findQR(image, workers, backend, config, config.deadline())
+
+def _findQR(image, workers, backend, config, deadline):
+	if deadline is not None and deadline.passed():
+		return []
+	if config.binarize:
+		image = binarizeImage(image, deadline=deadline)
+		if image is None:
+			return []
+	module_size = None
+	if config.pyramid_levels > 0:
+		all_points, module_size = getPyramidQRClusters(image, config.num_vectors, config.pyramid_levels, gather=True,
+			workers=workers, max_regions=None, backend=backend, leniency=config.leniency,
+			threshold=config.threshold, deadline=deadline, min_module=config.min_module)
+	else:
+		all_points = getMassQRClusters(image, config.num_vectors, gather=True, workers=workers,
+			leniency=config.leniency, min_module=config.min_module, backend=backend,
+			threshold=config.threshold, deadline=deadline)
+	parallelograms = [checkFinderLayout(image, pgram, config.threshold)
+		for pgram in findParallelograms(all_points, module_size, config.max_points)]
+	return [pgram for pgram in parallelograms if pgram is not None]
 
 
-def insertQR(image, data):
+def makeQRImage(data, box_size=4, version=None, error_correction=ERROR_CORRECT_M):
 	'''
 	@params:
-		image is the image that we'll be messing with
 		data is what will be encoded in the QR code
+		box_size is how many pixels wide each module is
+		version is the QR version (size) to use, None for the smallest that fits data
+		error_correction is one of the qrcode.constants.ERROR_CORRECT_* levels
+	returns a borderless PIL image of the QR code for data.
+		Images are cached in QR_IMAGE_CACHE and shared, so don't draw on them.
+	'''
+	def render():
+		import qrcode #loaded on first use, so importing myqr stays quick
+		qr_gen = qrcode.QRCode(
+			version = version,
+			box_size = box_size,
+			border = 0,
+			error_correction = error_correction
+		);
+		qr_gen.add_data(data)
+		qr_gen.make(fit=True)
+		return qr_gen.make_image()
+
+	return QR_IMAGE_CACHE.get((data, version, box_size, error_correction), render)
+
+def detectionKey(image, stage, **params):
+	'''
+	@params:
+		image is the image being searched
+		stage names the detection function, so each has its own entries
+		params are the detection options that change its result
+	returns a hex digest of image's decoded pixels, stage and params, for keying
+		a persistent cache of detection results such as qrcache.DiskCache
+	'''
+	digest = hashlib.sha256()
+	digest.update(repr((stage, DETECTION_VERSION, image.mode, image.size,
+		sorted(params.items()))).encode("utf-8"))
+	digest.update(image.tobytes())
+	return digest.hexdigest()
+
+def detectionConfig(config, **options):
+	'''
+	@params:
+		config is a qrconfig.DetectionConfig or preset name, or None
+		options are the separate detection keyword arguments the caller was given, _UNSET
+			for those it wasn't
+	returns config as a DetectionConfig (the balanced preset if None) with every option
+		that was passed put in, overriding config
+	'''
+	changes = {name: value for name, value in options.items() if value is not _UNSET}
+	config = qrconfig.getConfig(config)
+	return config.replace(**changes) if changes else config
+
+def cachedDetection(cache, key, config, detect):
+	'''
+	@params:
+		cache is the qrcache.DiskCache to look in
+		key is the entry to look up, from detectionKey
+		config is the DetectionConfig being detected with
+		detect is called with the config's Deadline (or None) on a miss, and returns
+			what to store
+	returns the cached result for key, detecting and storing it first if needed.
+		A result the deadline cut short isn't stored, so a later run can do better.
+	'''
+	found = cache.lookup(key)
+	if found is None:
+		deadline = config.deadline()
+		found = detect(deadline)
+		if deadline is None or not deadline.reached:
+			cache.store(key, found)
+	return found
+
+def cacheStats():
+	'''
+	returns a dict with the hit and miss counts of the QR image, warp mask and scan table caches
+	'''
+	return {"qr_images": QR_IMAGE_CACHE.stats(), "warp_masks": WARP_MASK_CACHE.stats(),
+		"scan_tables": SCAN_TABLE_CACHE.stats()}
+
+
+@qrtrace.traced()
+def insertQR(image, data, perspective=False, binarize=_UNSET, cache=None, config=None):
+	'''
+	@params:
+		image is the image that we'll be messing with
+		data is what will be encoded in the QR code, or a list of payloads to replace every
+			code in the image with, in findQR's order. Codes past the end of the list are left alone.
+		perspective is passed on to warpImage
+		binarize is passed on to scanImage2, the code is still pasted into the colors
+		cache is passed on to scanImage2, so repeat runs on one template skip detection
+		config is passed on to scanImage2 or findQR, its box_size to makeQRImage
 	inserts a QR code into the image at the specified bounds
 	the new qr code should fit the bounds and seem natural (like it was the original imge)
+	raises ValueError if data is one payload and no code is found to put it in
 	'''
-	qr_gen = qrcode.QRCode(
-		version = None,
-		box_size = 4,
-		border = 0
-	);
-	qr_gen.add_data(data)
-	qr_gen.make(fit=True)
-
-	qrCode = qr_gen.make_image()
-	pgram = scanImage2(image)
+	box_size = qrconfig.getConfig(config).box_size
+	if isinstance(data, (list, tuple)):
+		placements = [(makeQRImage(payload, box_size), pgram)
+			for pgram, payload in zip(findQR(image, binarize=binarize, cache=cache, config=config), data)]
+		return warpImages(image, placements, perspective)
+	qrCode = makeQRImage(data, box_size)
+	pgram = scanImage2(image, binarize=binarize, cache=cache, config=config)
+	if pgram is None:
+		raise ValueError("no QR code found to replace")
 	#pgram = expandParallelogram(pgram, 15)
-	return warpImage(image, qrCode, pgram)
+	return warpImage(image, qrCode, pgram, perspective)
+
+
+def warpRegion(background_size, image, parallelogram, perspective=False):
+	'''
+	@params:
+		background_size is the (width, height) of the image being pasted into
+		image, parallelogram and perspective are as in warpImage
+	returns (origin, transformed, mask): image warped into the bounding box of its target
+		area, clipped to the background, the box's upper left corner and the paste mask,
+		or None if the target area is off the background
+	'''
+	width, height = image.size
+	if perspective:
+		corners = list(parallelogram[:4])
+	else:
+		#An affine map sends the fourth corner to wherever the first three imply
+		corners = list(parallelogram[:3]) + [parallelogram[0] + parallelogram[2] - parallelogram[1]]
+
+	#Clip the target's bounding box to the background
+	left = max(int(math.floor(min(p.x for p in corners))), 0)
+	top = max(int(math.floor(min(p.y for p in corners))), 0)
+	right = min(int(math.ceil(max(p.x for p in corners))) + 1, background_size[0])
+	bottom = min(int(math.ceil(max(p.y for p in corners))) + 1, background_size[1])
+	if right <= left or bottom <= top:
+		return None
+	roi_size = (right - left, bottom - top)
+	origin = Point(left, top)
+
+	if perspective:
+		#Maps each box pixel back to the code, which is what PIL wants
+		source = [Point(0,0), Point(width,0), Point(width,height), Point(0,height)]
+		coefficients = perspectiveCoefficients([p - origin for p in corners], source)
+		method = Image.PERSPECTIVE
+	else:
+		mapped = np.array([[parallelogram[0].x, parallelogram[1].x, parallelogram[2].x],
+		[parallelogram[0].y, parallelogram[1].y, parallelogram[2].y], [1,1,1]])
+		original = np.array([[0, width, width],[0, 0, height]])
+
+		#solve for affine matrix
+		solution = np.dot(original, inv(mapped))
+		#unroll matrix into a sequence, shifted so the box's corner is (0,0)
+		coefficients = (solution[0][0], solution[0][1], solution[0][0]*left + solution[0][1]*top + solution[0][2],
+			solution[1][0], solution[1][1], solution[1][0]*left + solution[1][1]*top + solution[1][2])
+		method = Image.AFFINE
+	transformed = image.transform(roi_size, method, coefficients)
+
+	#The mask only depends on the geometry, so repeat placements reuse it
+	def warpMask():
+		white = Image.new("L", (width, height), 255)
+		return white.transform(roi_size, method, coefficients)
 
-def warpImage(background, image, parallelogram):
+	mask = WARP_MASK_CACHE.get(((width, height), roi_size, method, coefficients), warpMask)
+	return origin.asTuple(), transformed, mask
+
+@qrtrace.traced()
+def warpImage(background, image, parallelogram, perspective=False):
 	'''
 	@params:
 		background is unchanged image
 		image is image to be warped
 		parallelogram is the coordinates to warp the image to, starting at upper
 			left and going clockwise
+		perspective fits a homography to all four corners, so any quadrilateral works,
+			instead of an affine map through the first three
 	returns a new image that is the composition of background and image
 	 	after image has been warped
+		Only the bounding box of the target area is transformed and blended, so the
+		cost follows the size of the code rather than the size of background.
 	'''
-	mapped = np.array([[parallelogram[0].x, parallelogram[1].x, parallelogram[2].x],
-	[parallelogram[0].y, parallelogram[1].y, parallelogram[2].y], [1,1,1]])
+	return warpImages(background, [(image, parallelogram)], perspective)
 
-	width, height = image.size
-	original = np.array([[0, width, width],[0, 0, height]])
-
-	#solve for affine matrix
-	solution = np.dot(original, inv(mapped))
-	#unroll matrix into a sequence
-	affine = (solution[0][0], solution[0][1], solution[0][2], solution[1][0], solution[1][1], solution[1][2])
-	transformed = image.transform(background.size, Image.AFFINE, affine)
-	white = Image.new("RGBA", (width, height), "white")
-	transformedMask = white.transform(background.size, Image.AFFINE, affine)
-	background.paste(transformed, (0,0), transformedMask)
+@qrtrace.traced()
+def warpImages(background, placements, perspective=False):
+	'''
+	@params:
+		background is the image to paste into, changed in place
+		placements is a list of (image, parallelogram) pairs, as in warpImage
+		perspective is as in warpImage, for every placement
+	returns background with every image warped onto its parallelogram, later
+		placements on top where they overlap
+		Each image is warped into its own bounding box and blended straight into
+		background there, so time and memory follow the total area of the codes. No
+		full size image or mask is made, however many placements there are.
+	'''
+	size = background.size
+	for image, parallelogram in placements:
+		region = warpRegion(size, image, parallelogram, perspective)
+		if region is not None:
+			origin, transformed, mask = region
+			background.paste(transformed, origin, mask)
 	return background
 
-def getImageQRClusters(image, scan_vector):
+def scanStarts(size, scan_vector):
 	'''
 	@params:
-		image is the image to search for qr-clusters on
+		size is the (width, height) of the image to scan
 		scan_vector is a vector direction to traverse the image along.
-	returns a list of points representing the center of group-tuple strips satisfying
-		the QR code ratio.
+	returns the list of points getImageQRClusters starts a scanline from for scan_vector
 	'''
-	candidates = []
-	width = image.size[0]
-	height = image.size[1]
+	width = size[0]
+	height = size[1]
 	#Determine what generator to use to generate scanline starts
 	starts = []
 
@@ -176,51 +391,581 @@ def getImageQRClusters(image, scan_vector):
 		starts = itertools.chain(starts, top_edge)
 	elif scan_vector.y > 0:
 		starts = itertools.chain(starts, bot_edge)
+	return list(starts)
+
+@qrtrace.traced()
+def getImageQRClusters(image, scan_vector, starts=None, leniency=.2):
+	'''
+	@params:
+		image is the image to search for qr-clusters on
+		scan_vector is a vector direction to traverse the image along.
+		starts is an optional list of points to scan from, instead of the edges
+			given by scanStarts
+		leniency is how far off the 1:1:3:1:1 ratio may be, as in kindaEquals
+	returns a list of points representing the center of group-tuple strips satisfying
+		the QR code ratio.
+	'''
+	candidates = []
+	#Axis-aligned scans are much faster off a ScanGrid
+	axis = axisDirection(scan_vector)
+	if axis is not None and not isinstance(image, ScanGrid):
+		image = ScanGrid(image)
+	if starts is None:
+		starts = scanStarts(image.size, scan_vector)
+	qrtrace.count("scanlines", len(starts))
+
+	#Axis-aligned scans run and match every scanline at once off the grid
+	if axis is not None:
+		line_ids, segments = image.axisRuns(starts, axis)
+		return finderCandidates(line_ids, segments, leniency)
+
 	#For each start point select candidates
 	for start in starts:
 		#Gen groups from this start
 		groups = getColorGroups(image, start, scan_vector)
-		#Zip through sets of 5 groups to find 1:1:3:1:1
-		group_sets = [groups[i:] for i in range(5)]
-		for scan_set in zip(*group_sets):
-			#Compute lengths of each seg
-			scan_lengths = [scan_seg.length() for scan_seg in scan_set]
-			#Get length of first segnment as a  baseline to compare rest
-			base_len = scan_lengths[0]
-
-			#Since ratio is 1:1:3:1:1, adjust 3rd elt to be 1 so easier to compare
-			scan_lengths[2] /= 3
-
-			#Now check if all roughly equal
-			if all(kindaEquals(base_len, length) for length in scan_lengths):
-				center_set = scan_set[2]
-				candidates.append(center_set.midpoint())
+		candidates += matchFinderPattern(groups, leniency)
+
+	return PointArray.fromPoints(candidates)
+
+def matchFinderPattern(groups, leniency=.2):
+	'''
+	@params:
+		groups is a list of Segments from one scanline, in scan order
+		leniency is how far off the ratio may be, as in kindaEquals
+	returns a list of points, the midpoints of every Segment that is the center
+		of five consecutive Segments in the QR code ratio 1:1:3:1:1
+	'''
+	candidates = []
+	#Zip through sets of 5 groups to find 1:1:3:1:1
+	group_sets = [groups[i:] for i in range(5)]
+	for scan_set in zip(*group_sets):
+		#Compute lengths of each seg
+		scan_lengths = [scan_seg.length() for scan_seg in scan_set]
+		#Get length of first segnment as a  baseline to compare rest
+		base_len = scan_lengths[0]
+
+		#Since ratio is 1:1:3:1:1, adjust 3rd elt to be 1 so easier to compare
+		scan_lengths[2] /= 3
+
+		#Now check if all roughly equal
+		if all(kindaEquals(base_len, length, leniency) for length in scan_lengths):
+			center_set = scan_set[2]
+			candidates.append(center_set.midpoint())
 
 	return candidates
 
-def getMassQRClusters(image, num_vectors):
+@qrtrace.traced()
+def getTableQRClusters(grid, table, leniency=.2):
+	'''
+	@params:
+		grid is the ScanGrid to search for qr-clusters on
+		table is a ScanTable (see angleScanTable) the same size as grid
+		leniency is as in getImageQRClusters
+	returns a list of points like getImageQRClusters, for every scanline in table at once
+	'''
+	qrtrace.count("scanlines", len(table))
+	line_ids, segments = table.runs(grid)
+	return finderCandidates(line_ids, segments, leniency)
+
+@qrtrace.traced()
+def getAdaptiveQRClusters(grid, scan_vector, min_module=2, table=None, leniency=.2, backend=None, deadline=None):
+	'''
+	@params:
+		grid is the ScanGrid to search for qr-clusters on
+		scan_vector is the direction to scan along
+		min_module is the smallest module size, in pixels, that has to be found
+		table is the ScanTable to take the scanlines from in gather mode, None to scan
+			point by point from scanStarts
+		leniency is as in getImageQRClusters
+		backend is a qrbackends.Backend to scan the chosen lines with, from the table's
+			origins or scanStarts, instead of the default modes
+		deadline is a qrconfig.Deadline to stop scanning at, see scanChunks
+	returns the candidates of getImageQRClusters (or getTableQRClusters) on the scanlines
+		that matter. A finder pattern's center is 3 modules wide, so scanning every
+		2*min_module-th line crosses each one at least once; only the lines within a
+		stride of those hits are then scanned too. Every line through a finder's center
+		is still scanned, but the rest of the image only gets the sparse pass.
+	'''
+	stride = max(int(2*min_module), 1)
+	normal = Point(-scan_vector.y, scan_vector.x)
+	if backend is not None:
+		if table is not None:
+			starts = [Point(x, y) for x, y in table.origins.tolist()]
+		else:
+			starts = scanStarts(grid.size, scan_vector)
+		offsets = np.array([p.x*normal.x + p.y*normal.y for p in starts])
+		scan = lambda lines: backend.candidates(grid, scan_vector, [starts[i] for i in lines], leniency)
+	elif table is not None:
+		offsets = table.origins[:, 0]*normal.x + table.origins[:, 1]*normal.y
+		scan = lambda lines: getTableQRClusters(grid, table.select(lines), leniency)
+	else:
+		starts = scanStarts(grid.size, scan_vector)
+		offsets = np.array([p.x*normal.x + p.y*normal.y for p in starts])
+		scan = lambda lines: getImageQRClusters(grid, scan_vector, [starts[i] for i in lines], leniency)
+	if stride == 1 or len(offsets) == 0:
+		return scanChunks(scan, np.arange(len(offsets)), deadline)
+
+	#Scanlines side by side, so that neighbouring lines are neighbouring positions
+	order = np.argsort(offsets, kind="stable")
+	offsets = offsets[order]
+	coarse = scanChunks(scan, order[::stride], deadline)
+	if len(coarse) == 0 or (deadline is not None and deadline.passed()):
+		return coarse
+
+	#Find the line each hit lies on, then every line within a stride of it
+	hit_offsets = coarse.x*normal.x + coarse.y*normal.y
+	hits = np.clip(np.searchsorted(offsets, hit_offsets), 1, len(offsets) - 1)
+	hits -= hit_offsets - offsets[hits - 1] < offsets[hits] - hit_offsets
+	cover = np.zeros(len(offsets) + 1, dtype=np.int64)
+	np.add.at(cover, np.maximum(hits - stride + 1, 0), 1)
+	np.add.at(cover, np.minimum(hits + stride, len(offsets)), -1)
+	dense = np.cumsum(cover[:-1]) > 0
+	dense[::stride] = False #already scanned
+	return PointArray.concatenate([coarse, scanChunks(scan, order[dense], deadline)])
+
+def angleScanners(grid, angles, gather=False, leniency=.2, backend=None, spaced=False, lazy=False):
+	'''
+	@params:
+		grid is the ScanGrid to scan
+		angles are the directions to scan along, in radians
+		gather, leniency and backend are as in getMassQRClusters
+		spaced takes the scanlines from spacedScanTable rather than angleScanTable
+		lazy leaves tables that aren't cached yet unbuilt (see deferredScanTable), so the
+			first scan under a deadline doesn't wait on the whole table
+	returns a list of (count, scan) pairs, one per angle: how many scanlines it has, and
+		a function returning the candidates on an array of those lines' numbers, as
+		getMassQRClusters would find them
+	'''
+	width, height = grid.size
+	scanners = []
+	for theta in angles:
+		vector = Point(math.cos(theta), math.sin(theta))
+		table = None
+		if lazy and (spaced or gather):
+			table = deferredScanTable(width, height, theta, spaced)
+		elif spaced:
+			table = spacedScanTable(width, height, theta)
+		elif gather:
+			table = angleScanTable(width, height, theta)
+		if backend is not None:
+			starts = scanStarts(grid.size, vector) if table is None else [Point(x, y) for x, y in table.origins.tolist()]
+			scan = lambda lines, vector=vector, starts=starts: backend.candidates(grid, vector,
+				[starts[i] for i in lines], leniency)
+			scanners.append((len(starts), scan))
+		elif table is not None:
+			scan = lambda lines, table=table: getTableQRClusters(grid, table.select(lines), leniency)
+			scanners.append((len(table), scan))
+		else:
+			starts = scanStarts(grid.size, vector)
+			scan = lambda lines, vector=vector, starts=starts: getImageQRClusters(grid, vector,
+				[starts[i] for i in lines], leniency)
+			scanners.append((len(starts), scan))
+	return scanners
+
+def scanChunks(scan, lines, deadline, chunk=256):
+	'''
+	@params:
+		scan is a function returning the candidates on an array of scanline numbers,
+			as from angleScanners
+		lines is the array of scanline numbers to scan
+		deadline is the qrconfig.Deadline to stop at, None to scan every line in one go
+		chunk is the most scanlines scanned between two looks at the clock
+	returns the candidates scan found on lines, or on as many of them as it got to
+	'''
+	if deadline is None:
+		return scan(lines)
+	found = []
+	for first in range(0, len(lines), chunk):
+		if deadline.passed():
+			break
+		found.append(scan(lines[first:first + chunk]))
+	return PointArray.concatenate(found)
+
+def scanUntil(scanners, deadline):
+	'''
+	@params:
+		scanners is a list of (count, scan) pairs, as from angleScanners
+		deadline is the qrconfig.Deadline to stop at
+	returns a list of the candidates each scan found. Every deadline.bands-th line of each
+		scanner is scanned first, then the lines one after those and so on, so that the
+		whole image has been looked at, if sparsely, whenever the deadline passes.
+	'''
+	found = []
+	for band in range(deadline.bands):
+		for count, scan in scanners:
+			if deadline.passed():
+				return found
+			found.append(scanChunks(scan, np.arange(band, count, deadline.bands), deadline))
+	return found
+
+@qrtrace.traced()
+def getMassQRClusters(image, num_vectors, gather=False, workers=None, leniency=.2, min_module=None,
+		backend=None, angles=None, threshold=COLOR_THRESHOLD, deadline=None):
 	'''
 	@params:
 		image is the image to scan,
 		num_vectors is the number of different vectors to scan along
+		gather selects the table mode: every angle is scanned with one NumPy gather over
+			a cached ScanTable (see angleScanTable) instead of point by point. Its scanlines
+			start on every edge the vector enters the image through, so they cover the
+			whole image at any angle.
+		workers spreads the angles, and bands of scanlines within each angle, over a
+			process pool (see parallelscan). Either a number of processes or a
+			parallelscan.ParallelScanner to reuse. The result is the same as without.
+		leniency is how far off the 1:1:3:1:1 ratio may be, as in kindaEquals
+		min_module scans adaptively (see getAdaptiveQRClusters), finding codes with
+			modules at least this many pixels wide in a fraction of the scanlines.
+			Not used with workers.
+		backend is the qrbackends engine, or its name, to scan and match with. If not
+			given, the QR_BACKEND environment variable names it, and without that the
+			mode is chosen by gather as above. Not used with workers.
+		angles lists the directions to scan along, in radians, instead of num_vectors
+			evenly spread ones. Not used with workers.
+		threshold is the diffColors value neighbouring pixels must exceed to split a run,
+			when image isn't a ScanGrid already
+		deadline is a qrconfig.Deadline to stop scanning at, returning the candidates
+			found so far. Scanlines are then scanned in interleaved bands (see scanUntil),
+			and tables and breaks are made a band at a time too. Can't be kept across
+			worker processes, so a ValueError is raised if workers are given as well.
 	returns the combined result of running getImageQRClusters over the image from
 		many different angles, to counteract possible rotational artifacts.
 	'''
-	angle_delta = math.pi / num_vectors
-	vec_angles = [x*angle_delta for x in range(num_vectors)]
+	if workers and deadline is not None:
+		raise ValueError("a deadline can't be kept across worker processes, drop the workers or the time budget")
+	if deadline is not None and deadline.passed():
+		return PointArray([])
+	if angles is None:
+		angle_delta = math.pi / num_vectors
+		vec_angles = [x*angle_delta for x in range(num_vectors)]
+	else:
+		vec_angles = list(angles)
 	vectors = [Point(math.cos(theta), math.sin(theta)) for theta in vec_angles]
 
-	#Generate points for each vector
-	qr_points = []
-	for vec in vectors:
-		qr_points += getImageQRClusters(image, vec)
+	if workers:
+		import parallelscan #parallelscan imports this module, so it is loaded on demand
+		if not isinstance(image, ScanGrid):
+			image = ScanGrid(image, threshold)
+		qr_points = parallelscan.getMassQRClusters(image, num_vectors, gather, workers, leniency)
+		qrtrace.count("candidates", len(qr_points))
+		return qr_points
+
+	#Convert the image once and share it between every vector
+	grid = image if isinstance(image, ScanGrid) else ScanGrid(image, threshold)
+	backend = qrbackends.getBackend(backend)
 
+	if min_module:
+		width, height = grid.size
+		qr_points = []
+		for theta, vec in zip(vec_angles, vectors):
+			if deadline is not None and deadline.passed():
+				break
+			table = None
+			if gather:
+				table = angleScanTable(width, height, theta) if deadline is None else deferredScanTable(width, height, theta)
+			qr_points.append(getAdaptiveQRClusters(grid, vec, min_module, table, leniency, backend, deadline))
+	elif deadline is not None:
+		qr_points = scanUntil(angleScanners(grid, vec_angles, gather, leniency, backend, lazy=True), deadline)
+	elif backend is not None:
+		width, height = grid.size
+		qr_points = []
+		for theta, vec in zip(vec_angles, vectors):
+			if gather:
+				starts = [Point(x, y) for x, y in angleScanTable(width, height, theta).origins.tolist()]
+			else:
+				starts = scanStarts(grid.size, vec)
+			qrtrace.count("scanlines", len(starts))
+			qr_points.append(backend.candidates(grid, vec, starts, leniency))
+	elif gather:
+		width, height = grid.size
+		qr_points = [getTableQRClusters(grid, angleScanTable(width, height, theta), leniency)
+			for theta in vec_angles]
+	else:
+		#Generate points for each vector
+		qr_points = [getImageQRClusters(grid, vec, leniency=leniency) for vec in vectors]
+	qr_points = PointArray.concatenate(qr_points)
+	qrtrace.count("candidates", len(qr_points))
 	return qr_points
 
-def scanImage2(image):
-	all_points = getMassQRClusters(image, 2)
-	all_points = [p.asTuple() for p in all_points]
-	pgram = constructParallelograms(all_points)
+@qrtrace.traced()
+def getPyramidQRClusters(image, num_vectors, levels=2, gather=False, workers=None, max_regions=12,
+		coarse_leniency=.5, backend=None, leniency=.2, threshold=COLOR_THRESHOLD, deadline=None, min_module=None):
+	'''
+	@params:
+		image is the image to scan
+		num_vectors, gather, workers, backend, leniency, threshold and deadline are as in
+			getMassQRClusters. Once the deadline passes, the regions rescanned so far are
+			all there is.
+		levels is how many times to halve the image for the coarse pass
+		max_regions is how many coarse clusters get rescanned at full resolution, None for all
+		coarse_leniency is the ratio leniency of the coarse pass. Modules there are only a
+			few pixels wide, so a pixel more or less throws the ratio off, and anything
+			it lets through wrongly is weeded out by the full resolution pass.
+		min_module is as in getMassQRClusters, for the full resolution scan it falls back on
+	returns (points, module_size): full resolution candidates like getMassQRClusters, and
+		the module size estimated on them.
+		Finder patterns are found on a 1/2**levels copy of image, and only a box around
+		each is scanned again at full resolution to place the centers precisely. The
+		three heaviest finder patterns found must be of a weight, square up into a code
+		(see groupFinders) and each pass crossCheckFinder, so a coarse pass that missed
+		one, or whose rescan box cut one off, can't hand over a look-alike in its place. If they don't, or the modules come out under two
+		pixels on the copy, the copy is made half as small and scanned again, down to
+		1/PYRAMID_MIN_SCALE of image, and past that the whole image is scanned.
+	'''
+	#Don't shrink so far that the coarse copy has nothing left to scan
+	scale = 2**levels
+	while scale > 1 and min(image.size) // scale < 32:
+		scale //= 2
+	if scale == 1:
+		points = getMassQRClusters(image, num_vectors, gather, workers, leniency, min_module, backend=backend,
+			threshold=threshold, deadline=deadline)
+		return points, None
+
+	while True:
+		#Nearest neighbour, since blended edge pixels would split runs and hide the ratio
+		small = image.resize((image.size[0] // scale, image.size[1] // scale), Image.NEAREST)
+		coarse = getMassQRClusters(small, num_vectors, gather, workers, coarse_leniency, backend=backend,
+			threshold=threshold, deadline=deadline)
+		points, weights = aggregatePoints(coarse)
+		coarse_module = estimateModuleSize(points, weights) if len(points) else 0
+		#One pixel modules make finder ratios all over the data, not worth rescanning
+		if len(points) and (coarse_module >= 2 or scale <= PYRAMID_MIN_SCALE):
+			module_size = coarse_module * scale
+			qr_points = rescanRegions(image, clusterPoints(points, max(1.5*coarse_module, 2), weights)[:max_regions],
+				scale, module_size, num_vectors, gather, leniency, backend, threshold, deadline)
+			if deadline is not None and deadline.passed():
+				return qr_points, module_size
+			#The three heaviest patterns are what constructParallelograms will take. Every line
+			#through a finder's center was rescanned, so the three of a code weigh alike, and
+			#their spacings match closer than groupFinders needs when it sorts through a scene.
+			points, weights = aggregatePoints(qr_points)
+			if len(points):
+				module_size = estimateModuleSize(points, weights)
+			found = clusterPoints(points, max(1.5*module_size, 2), weights)[:3]
+			if (len(found) == 3 and found[2][1] >= PYRAMID_MIN_WEIGHT_RATIO*found[0][1] and
+					groupFinders(np.array([center for center, weight in found]), [module_size]*3,
+						side_tolerance=PYRAMID_SIDE_TOLERANCE) and
+					all(crossCheckFinder(image, Point(*center), threshold) for center, weight in found)):
+				return qr_points, module_size
+		if scale <= PYRAMID_MIN_SCALE or (deadline is not None and deadline.passed()):
+			break
+		scale //= 2
+
+	qrtrace.count("pyramid_fallbacks")
+	return getMassQRClusters(image, num_vectors, gather, workers, leniency, min_module, backend=backend,
+		threshold=threshold, deadline=deadline), None
+
+def rescanRegions(image, regions, scale, module_size, num_vectors, gather, leniency, backend, threshold,
+		deadline):
+	'''
+	@params:
+		image is the full resolution image
+		regions are (center, weight) clusters found on a 1/scale copy of image
+		module_size is the module size on the copy, times scale
+		num_vectors, gather, leniency, backend, threshold and deadline are as in getMassQRClusters
+	returns the candidates found by scanning a box around each region again at full
+		resolution, in image coordinates. Regions are rescanned in order until the deadline.
+	'''
+	#A finder pattern is 7 modules wide, rescan it whole plus a margin
+	half = int(math.ceil(5*module_size)) + scale
+	width, height = image.size
+	qr_points = []
+	for (x, y), weight in regions:
+		if deadline is not None and deadline.passed():
+			break
+		x = (x + 0.5) * scale #center of the block each coarse pixel covers
+		y = (y + 0.5) * scale
+		box = (max(int(x) - half, 0), max(int(y) - half, 0),
+			min(int(x) + half + 1, width), min(int(y) + half + 1, height))
+		offset = Point(box[0], box[1])
+		region = getMassQRClusters(image.crop(box), num_vectors, gather, leniency=leniency, backend=backend,
+			threshold=threshold) + offset
+		#Runs cut short by the crop can fake the ratio near its border, keep the middle only
+		keep = half - 2*module_size
+		qr_points.append(region[(abs(region.x - x) <= keep) & (abs(region.y - y) <= keep)])
+	return PointArray.concatenate(qr_points)
+
+def crossCheckFinder(image, center, threshold=COLOR_THRESHOLD, leniency=.3, nudge=2):
+	'''
+	@params:
+		image is the full resolution image
+		center is where a finder pattern was found
+		threshold is as in getMassQRClusters
+		leniency is how far off the ratio the profile may be, as in kindaEquals. A little
+			looser than the scans', since only a handful of lines are read.
+		nudge is how many pixels to either side a line may be moved when one through the
+			center has a run split by noise
+	returns (center, module size): the center refined along the column and then the row
+		through it, and the module size its profile gives. None if no line there crosses
+		a 1:1:3:1:1 profile centered on it, or the refined center is more than
+		PYRAMID_MAX_SHIFT modules away. Any line through a finder's
+		center crosses its rings in the ratio, whatever the code's rotation, but a
+		cluster sitting beside a finder, off candidates from its edge, doesn't.
+	'''
+	width, height = image.size
+	refined = [center.x, center.y]
+	offsets = [0] + [sign*step for step in range(1, nudge + 1) for sign in (-1, 1)]
+	for axis in (1, 0, 1): #the column again last, through the refined row
+		for offset in offsets:
+			x, y = int(refined[0]) + offset*axis, int(refined[1]) + offset*(1 - axis)
+			if not (0 <= x < width and 0 <= y < height):
+				continue
+			line = image.crop((x, 0, x + 1, height) if axis else (0, y, width, y + 1))
+			groups = ScanGrid(line, threshold).colorGroups(Point(0, 0), Point(0, 1) if axis else Point(1, 0))
+			at = refined[axis]
+			inside = [k for k, group in enumerate(groups) if group.p1.asTuple()[axis] <= at <= group.p2.asTuple()[axis]]
+			if not inside or not 2 <= inside[0] < len(groups) - 2:
+				continue
+			profile = groups[inside[0] - 2:inside[0] + 3]
+			#Counted in pixels, a Segment's length is one short, which matters for small modules
+			pixels = [group.length() + 1 for group in profile]
+			if all(kindaEquals(pixels[0], count/(3 if k == 2 else 1), leniency) for k, count in enumerate(pixels)):
+				break
+		else:
+			return None
+		refined[axis] = profile[2].midpoint().asTuple()[axis]
+		module = sum(pixels) / 7
+	if Point(*refined).distance(center) > PYRAMID_MAX_SHIFT*module:
+		return None
+	return Point(*refined), module
+
+def checkFinderLayout(image, pgram, threshold=COLOR_THRESHOLD, side_tolerance=.3,
+		angle_tolerance=math.radians(25), size_tolerance=.3):
+	'''
+	@params:
+		image is the image pgram was found in
+		pgram is a parallelogram from findParallelograms, three of its corners finder centers
+		threshold is as in getMassQRClusters
+		side_tolerance, angle_tolerance and size_tolerance are as in groupFinders
+	returns pgram rebuilt on the finder centers crossCheckFinder refines, or None if any
+		of them isn't a finder at full resolution, their module sizes differ, they don't
+		make a right angle with equal legs, or the legs aren't FINDER_SPACING modules
+		long. The clusters groupFinders sorts through only carry a module size guessed
+		from their spread, so three look-alikes can square up there.
+	'''
+	found = [crossCheckFinder(image, pgram[k], threshold) for k in (0, 1, 3)]
+	if None in found:
+		return None
+	(corner, size), (right, right_size), (left, left_size) = found
+	sizes = (size, right_size, left_size)
+	if max(sizes) > (1 + size_tolerance)*min(sizes):
+		return None
+	module = sum(sizes) / 3
+	low, high = FINDER_SPACING
+	#A line through a finder turned 45 degrees reads its modules up to sqrt(2) wide
+	for leg in (right, left):
+		if not low*(1 - side_tolerance)/math.sqrt(2) <= leg.distance(corner)/module <= high*(1 + side_tolerance):
+			return None
+	refined = (corner, right, right + left - corner, left)
+	if not plausibleParallelogram(refined, 1 + side_tolerance, math.cos(angle_tolerance)):
+		return None
+	return refined
+
+@qrtrace.traced()
+def getOrientedQRClusters(image, gather=False, leniency=.2, backend=None, min_margin=2,
+		num_vectors=2, threshold=COLOR_THRESHOLD, deadline=None):
+	'''
+	@params:
+		image is the PIL image to scan
+		gather, leniency, backend, num_vectors, threshold and deadline are as in
+			getMassQRClusters
+		min_margin is how many times heavier the third finder cluster has to be than the
+			fourth for the first pass to be trusted
+	returns candidates like getMassQRClusters, found by scanning only where it pays.
+		The first pass is the usual num_vectors scans. If three finder clusters
+		clearly stand out, that's it. Otherwise the code's rotation is estimated from
+		its edges (see dominantAngle) and two more scans are made, along the code's
+		diagonals. Scanning along the code's own axes would pick up the 1:1:3:1:1 runs
+		in its data modules too, while diagonally only the finder patterns, being
+		concentric squares, still show the ratio. Rotated codes then cost two more
+		passes, instead of every code paying for a wider fixed sweep.
+	'''
+	if deadline is not None and deadline.passed():
+		return PointArray([])
+	grid = ScanGrid(image, threshold)
+	points = getMassQRClusters(grid, num_vectors, gather, leniency=leniency, backend=backend, deadline=deadline)
+	if deadline is not None and deadline.passed():
+		return points
+	if len(points) > 0:
+		aggregated, weights = aggregatePoints(points)
+		module_size = estimateModuleSize(aggregated, weights)
+		found = [weight for center, weight in clusterPoints(aggregated, max(1.5*module_size, 2), weights)]
+		if len(found) >= 3 and (len(found) == 3 or found[2] >= min_margin*found[3]):
+			return points
+
+	qrtrace.count("oriented_rescans")
+	theta = dominantAngle(image)
+	scanners = angleScanners(grid, (theta + math.pi/4, theta + 3*math.pi/4), leniency=leniency, backend=backend,
+		spaced=True, lazy=deadline is not None)
+	if deadline is not None:
+		diagonals = scanUntil(scanners, deadline)
+	else:
+		diagonals = [scan(np.arange(count)) for count, scan in scanners]
+	return PointArray.concatenate([points] + diagonals)
+
+@qrtrace.traced()
+def scanImage2(image, workers=None, pyramid_levels=_UNSET, binarize=_UNSET, min_module=_UNSET, cache=None,
+		backend=None, orient=_UNSET, config=None):
+	'''
+	@params:
+		image is the image to find a QR code in
+		workers is passed on to getMassQRClusters to scan across processes
+		pyramid_levels turns on coarse to fine detection (see getPyramidQRClusters)
+			when above 0, it is how many times the coarse copy is halved. 0 by default.
+		binarize scans a locally thresholded single band copy (see binarizeImage)
+			instead of the colors, for low contrast and unevenly lit photos
+		min_module scans adaptively for codes with modules at least this many pixels
+			wide, see getAdaptiveQRClusters. None, for a full scan, by default.
+		cache is a qrcache.DiskCache to look the result up in first, keyed by
+			detectionKey. Three of the parallelogram's corners are the finder centers.
+		backend is the qrbackends engine, or its name, to scan, match and cluster with,
+			see getMassQRClusters
+		orient adds scans along the code's diagonals when the axis-aligned ones leave
+			the finder patterns in doubt, for rotated codes, see getOrientedQRClusters.
+			Not used with workers, pyramid_levels or min_module. Soft edged photos of
+			rotated codes, like tiltedQRcode.jpg, need binarize too, their blurred edges
+			split the color runs.
+		config is a qrconfig.DetectionConfig or the name of one of its presets, holding
+			every detection setting including a time budget. pyramid_levels, binarize,
+			min_module and orient override it whenever they are passed, and only default
+			to the values above when neither they nor config are given.
+	returns the parallelogram around the QR code, or None if fewer than three finder
+		patterns were found, such as when the time budget ran out first
+	'''
+	config = detectionConfig(config, pyramid_levels=pyramid_levels, binarize=binarize, min_module=min_module,
+		orient=orient)
+	if cache is not None:
+		key = detectionKey(image, "scanImage2", **dict(config.key()))
+		#Not finding a code is stored as an empty list, json can't tell None from a miss
+		pgram = cachedDetection(cache, key, config, lambda deadline: [p.asTuple() for p in
+			_scanImage2(image, workers, backend, config, deadline) or ()])
+		return tuple(Point(x, y) for x, y in pgram) if pgram else None
+	return _scanImage2(image, workers, backend, config, config.deadline())
+
+def _scanImage2(image, workers, backend, config, deadline):
+	if deadline is not None and deadline.passed():
+		return None
+	if config.binarize:
+		image = binarizeImage(image, deadline=deadline)
+		if image is None:
+			return None
+	backend = qrbackends.getBackend(backend)
+	module_size = None
+	if config.pyramid_levels > 0:
+		all_points, module_size = getPyramidQRClusters(image, config.num_vectors, config.pyramid_levels,
+			config.gather, workers, config.max_regions, backend=backend, leniency=config.leniency,
+			threshold=config.threshold, deadline=deadline, min_module=config.min_module)
+	elif config.orient and not workers and not config.min_module:
+		all_points = getOrientedQRClusters(image, config.gather, config.leniency, backend,
+			num_vectors=config.num_vectors, threshold=config.threshold, deadline=deadline)
+	else:
+		all_points = getMassQRClusters(image, config.num_vectors, config.gather, workers, config.leniency,
+			config.min_module, backend=backend, threshold=config.threshold, deadline=deadline)
+	pgram = constructParallelograms(all_points, module_size, config.max_points,
+		method=backend.cluster if backend is not None else config.cluster_method)
+	#Candidates cut short can leave a look-alike among the three heaviest clusters
+	if pgram is not None and deadline is not None and deadline.reached and not plausibleParallelogram(pgram):
+		qrtrace.count("implausible_parallelograms")
+		return None
 	return pgram
 
 
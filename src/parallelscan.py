@@ -0,0 +1,171 @@
+#!/usr/bin/env python3
+import math
+import os
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+import numpy as np
+from mathobjects import *
+from scanlines import *
+import myqr
+
+'''
+NOTE:
+a band is one task's share of a single scan angle: band i of n covers the ith nth of that
+angle's scanlines (start points for the point by point scan, table lines for gather mode)
+
+workers never receive pixels, only the name of the shared memory block holding the pixel
+array, which they map once per image
+'''
+
+#The grid of the image this worker process is currently mapped onto, as (name, block, grid)
+_attached = None
+
+
+def _attachGrid(name, shape, threshold):
+	'''
+	@params:
+		name is the shared memory block holding the pixel array
+		shape is the shape of that pixel array
+		threshold is the diffColors threshold to scan with
+	returns a ScanGrid over the shared pixels, mapping them on first use in this process
+	'''
+	global _attached
+	if _attached is not None and _attached[0] == name:
+		return _attached[2]
+	if _attached is not None: #the last image is done with, let go of it
+		block = _attached[1]
+		_attached = None #drops the grid, which holds views into block
+		block.close()
+	try:
+		block = shared_memory.SharedMemory(name=name, track=False)
+	except TypeError: #track is 3.13+, before that the parent's tracker owns the block anyway
+		block = shared_memory.SharedMemory(name=name)
+	pixels = np.ndarray(shape, dtype=np.int16, buffer=block.buf)
+	_attached = (name, block, ScanGrid(pixels, threshold))
+	return _attached[2]
+
+
+def _bandOf(items, band, num_bands):
+	'''
+	returns the first and last+1 index of band number band out of num_bands over items
+	'''
+	return len(items)*band // num_bands, len(items)*(band + 1) // num_bands
+
+
+def _axisBand(grid, starts, axis, leniency):
+	'''
+	@params:
+		grid is the ScanGrid to scan
+		starts is a list of lattice points, all scanning along axis
+		axis is an integer unit vector
+		leniency is as in myqr.getImageQRClusters
+	returns a PointArray of candidates, scanning only the rows or columns starts lie on
+		so a worker never computes breaks for lines belonging to other bands
+	'''
+	width, height = grid.size
+	x0, x1, y0, y1 = 0, width, 0, height
+	if axis.y == 0:
+		y0 = min(p.y for p in starts)
+		y1 = max(p.y for p in starts) + 1
+	else:
+		x0 = min(p.x for p in starts)
+		x1 = max(p.x for p in starts) + 1
+	sub = ScanGrid(grid.pixels[y0:y1, x0:x1], grid.threshold)
+	offset = Point(x0, y0)
+	line_ids, segments = sub.axisRuns([p - offset for p in starts], axis)
+	return finderCandidates(line_ids, segments, leniency) + offset
+
+
+def _scanBand(name, shape, threshold, angle, band, num_bands, gather, leniency):
+	'''
+	Runs in a worker. Scans one band of one angle of the shared image.
+	returns a PointArray of candidate points
+	'''
+	grid = _attachGrid(name, shape, threshold)
+	width, height = grid.size
+	if gather:
+		table = angleScanTable(width, height, angle)
+		first, last = _bandOf(range(len(table)), band, num_bands)
+		line_ids, segments = table.band(first, last).runs(grid)
+		return finderCandidates(line_ids, segments, leniency)
+
+	vec = Point(math.cos(angle), math.sin(angle))
+	starts = myqr.scanStarts(grid.size, vec)
+	first, last = _bandOf(starts, band, num_bands)
+	starts = starts[first:last]
+	if len(starts) == 0:
+		return PointArray([])
+	axis = axisDirection(vec)
+	if axis is not None:
+		return _axisBand(grid, starts, axis, leniency)
+	return myqr.getImageQRClusters(grid, vec, starts, leniency)
+
+
+class ParallelScanner:
+	'''
+	A pool of worker processes that scan one image's angles and bands at once.
+	Keep one around and reuse it, since starting the pool costs more than a small scan.
+	Use as a context manager, or call close when done.
+	'''
+	def __init__(self, workers=None, bands_per_worker=2):
+		'''
+		@params:
+			workers is the number of processes, defaulting to the number of cores
+			bands_per_worker is how many bands each angle is cut into per worker, so
+				cheap and expensive angles even out
+		'''
+		self.workers = workers or os.cpu_count() or 1
+		self.bands_per_worker = bands_per_worker
+		self.pool = ProcessPoolExecutor(self.workers)
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *exc):
+		self.close()
+
+	def close(self):
+		self.pool.shutdown()
+
+	def getMassQRClusters(self, image, num_vectors, gather=False, leniency=.2):
+		'''
+		@params:
+			image is the image (or ScanGrid) to scan
+			num_vectors, gather and leniency are as in myqr.getMassQRClusters
+		returns the same points as myqr.getMassQRClusters, in the same order
+		'''
+		if not isinstance(image, ScanGrid):
+			image = ScanGrid(image)
+		pixels = image.pixels
+		threshold = image.threshold
+		block = shared_memory.SharedMemory(create=True, size=max(pixels.nbytes, 1))
+		try:
+			shared = np.ndarray(pixels.shape, dtype=np.int16, buffer=block.buf)
+			shared[:] = pixels
+
+			angle_delta = math.pi / num_vectors
+			num_bands = self.workers * self.bands_per_worker
+			tasks = [self.pool.submit(_scanBand, block.name, pixels.shape, threshold,
+				x*angle_delta, band, num_bands, gather, leniency)
+				for x in range(num_vectors) for band in range(num_bands)]
+			#Merge in submission order so results never depend on which worker was fastest
+			candidates = PointArray.concatenate([task.result() for task in tasks])
+		finally:
+			shared = None #views into block have to go before it can close
+			block.close()
+			block.unlink()
+		return candidates
+
+
+def getMassQRClusters(image, num_vectors, gather=False, workers=None, leniency=.2):
+	'''
+	@params:
+		image is the image to scan
+		num_vectors, gather and leniency are as in myqr.getMassQRClusters
+		workers is a ParallelScanner to use, or a number of processes to start one with
+	returns the result of myqr.getMassQRClusters, computed across processes
+	'''
+	if isinstance(workers, ParallelScanner):
+		return workers.getMassQRClusters(image, num_vectors, gather, leniency)
+	with ParallelScanner(workers) as scanner:
+		return scanner.getMassQRClusters(image, num_vectors, gather, leniency)
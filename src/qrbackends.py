@@ -0,0 +1,387 @@
+#!/usr/bin/env python3
+import argparse
+import glob
+import math
+import os
+import sys
+import numpy as np
+from PIL import Image
+from mathutil import *
+from mathobjects import *
+from scanlines import *
+
+'''
+Interchangeable engines for the three inner steps of detection: scanning lines into
+runs, matching runs against the 1:1:3:1:1 finder ratio, and clustering candidates.
+
+Usage:
+	points = myqr.getMassQRClusters(image, 2, backend="numpy")
+	pgram = myqr.scanImage2(image, backend="numba")
+	QR_BACKEND=numpy python batchqr.py ...
+
+	python qrbackends.py --check
+
+NOTE:
+"reference" is the original code: getColorGroups walks every scanline pixel by pixel
+through getpixel, and matchFinderPattern checks it five runs at a time. It is slow, and
+is what the other engines are checked against.
+
+"numpy" gathers every scanline's samples at once through a ScanTable and matches every
+window with finderCandidates.
+
+"numba" compiles the break and ratio loops with numba's JIT. It is only available when
+numba is installed.
+
+a backend is picked per call by name or instance, otherwise from the QR_BACKEND
+environment variable. When neither is given, myqr keeps its own choice of scan mode.
+Clustering is clusterPoints in every engine so far.
+'''
+
+#The environment variable naming the backend to use when a call doesn't
+BACKEND_VARIABLE = "QR_BACKEND"
+
+
+class Backend:
+	'''
+	One detection engine. Subclasses override runs and match, and cluster if they have
+	their own clustering.
+	'''
+	name = None
+
+	def available(self):
+		'''
+		returns true if everything this backend needs is installed
+		'''
+		return True
+
+	def runs(self, grid, scan_vector, starts):
+		'''
+		@params:
+			grid is the ScanGrid to scan
+			scan_vector is the direction to scan along
+			starts is a list of points to start a scanline from, inside grid
+		returns a run array with one scanline per start, as in scanlines
+		'''
+		raise NotImplementedError
+
+	def match(self, line_ids, segments, leniency=.2):
+		'''
+		returns a PointArray of the centers of every 1:1:3:1:1 window of the run array,
+			as in finderCandidates
+		'''
+		raise NotImplementedError
+
+	def cluster(self, points, radius, weights=None):
+		'''
+		returns a list of cluster-tuples of points, as in clusterPoints
+		'''
+		return clusterPoints(points, radius, weights)
+
+	def candidates(self, grid, scan_vector, starts, leniency=.2):
+		'''
+		returns a PointArray of finder candidates on the scanlines from starts
+		'''
+		line_ids, segments = self.runs(grid, scan_vector, starts)
+		return self.match(line_ids, segments, leniency)
+
+	def __repr__(self):
+		return "<{} backend>".format(self.name)
+
+
+class _PixelView:
+	'''
+	Just a size and getpixel over a ScanGrid, so getColorGroups can't take its fast paths.
+	'''
+	def __init__(self, grid):
+		self.size = grid.size
+		self.getpixel = grid.getpixel
+
+
+class ReferenceBackend(Backend):
+	name = "reference"
+
+	def runs(self, grid, scan_vector, starts):
+		import myqr
+		view = _PixelView(grid)
+		line_ids = []
+		firsts = []
+		lasts = []
+		for line, start in enumerate(starts):
+			groups = myqr.getColorGroups(view, start, scan_vector)
+			line_ids += [line]*len(groups)
+			firsts += [group.p1.asTuple() for group in groups]
+			lasts += [group.p2.asTuple() for group in groups]
+		return (np.array(line_ids, dtype=np.int64),
+			SegmentArray(PointArray(np.reshape(firsts, (-1, 2))), PointArray(np.reshape(lasts, (-1, 2)))))
+
+	def match(self, line_ids, segments, leniency=.2):
+		import myqr
+		candidates = []
+		#Runs of one scanline are contiguous, hand them over a scanline at a time
+		bounds = np.flatnonzero(np.diff(line_ids)) + 1
+		for lo, hi in zip(np.concatenate(([0], bounds)), np.concatenate((bounds, [len(line_ids)]))):
+			groups = [Segment(Point(*segments.p1.xy[i]), Point(*segments.p2.xy[i])) for i in range(lo, hi)]
+			candidates += myqr.matchFinderPattern(groups, leniency)
+		return PointArray.fromPoints(candidates)
+
+
+def scanTable(grid, scan_vector, starts):
+	'''
+	returns the ScanTable of the scanlines from starts across grid along scan_vector
+	'''
+	axis = axisDirection(scan_vector)
+	direction = axis if axis is not None else scan_vector
+	origins = np.array([start.asTuple() for start in starts], dtype=np.float64)
+	return linesScanTable(grid.size[0], grid.size[1], origins, direction.asTuple())
+
+
+class NumpyBackend(Backend):
+	name = "numpy"
+
+	def runs(self, grid, scan_vector, starts):
+		if len(starts) == 0:
+			return np.empty(0, dtype=np.int64), SegmentArray([], [])
+		return scanTable(grid, scan_vector, starts).runs(grid)
+
+	def match(self, line_ids, segments, leniency=.2):
+		return finderCandidates(line_ids, segments, leniency)
+
+
+def tableEnds(pixels, indices, offsets, threshold):
+	'''
+	@params:
+		pixels is a pixel array flattened to (height*width, channels)
+		indices, offsets are those of a ScanTable
+		threshold is as in ScanGrid
+	returns the ends array of ScanTable.runs, one loop over the samples. Plain Python
+		here, NumbaBackend compiles it.
+	'''
+	ends = np.zeros(len(indices), dtype=np.bool_)
+	for line in range(len(offsets) - 1):
+		lo = offsets[line]
+		hi = offsets[line + 1]
+		for k in range(lo, hi - 1):
+			delta = 0
+			for c in range(pixels.shape[1]):
+				delta += abs(int(pixels[indices[k], c]) - int(pixels[indices[k + 1], c]))
+			ends[k] = delta > threshold
+		if hi > lo:
+			ends[hi - 1] = True
+	return ends
+
+
+def ratioWindows(line_ids, lengths, leniency):
+	'''
+	returns the index of the center run of every 1:1:3:1:1 window of runs, the same
+		test as finderCandidates one window at a time. Plain Python here, NumbaBackend
+		compiles it.
+	'''
+	centers = np.empty(max(len(lengths) - 4, 0), dtype=np.int64)
+	found = 0
+	for i in range(len(lengths) - 4):
+		if line_ids[i] != line_ids[i + 4]:
+			continue
+		base_len = lengths[i]
+		n2_max = base_len*(1 + leniency)
+		n2_min = base_len*(1 - leniency)
+		matched = True
+		for offset in range(1, 5):
+			length = lengths[i + offset]
+			if offset == 2:
+				length = length/3
+			if not (length == base_len or (length < n2_max and length > n2_min)):
+				matched = False
+				break
+		if matched:
+			centers[found] = i + 2
+			found += 1
+	return centers[:found]
+
+
+class NumbaBackend(Backend):
+	name = "numba"
+
+	def __init__(self):
+		self._kernels = None
+
+	def available(self):
+		try:
+			import numba
+		except ImportError:
+			return False
+		return True
+
+	def kernels(self):
+		'''
+		returns the compiled (tableEnds, ratioWindows), compiling them on first use
+		'''
+		if self._kernels is None:
+			import numba #optional, and slow to import
+			self._kernels = (numba.njit(cache=True)(tableEnds), numba.njit(cache=True)(ratioWindows))
+		return self._kernels
+
+	def runs(self, grid, scan_vector, starts):
+		if len(starts) == 0:
+			return np.empty(0, dtype=np.int64), SegmentArray([], [])
+		table = scanTable(grid, scan_vector, starts)
+		height, width, channels = grid.pixels.shape
+		ends = self.kernels()[0](grid.pixels.reshape(-1, channels), table.indices, table.offsets,
+			grid.threshold)
+		return maskRuns(ends, table.offsets, table.origins, table.direction)
+
+	def match(self, line_ids, segments, leniency=.2):
+		if len(line_ids) < 5:
+			return PointArray([])
+		centers = self.kernels()[1](line_ids, segments.length(), float(leniency))
+		return segments[centers].midpoint()
+
+
+#Backends by name
+BACKENDS = {}
+
+
+def registerBackend(backend):
+	'''
+	adds backend to the registry under its name, replacing any backend of that name
+	'''
+	BACKENDS[backend.name] = backend
+	return backend
+
+
+for _backend in (ReferenceBackend(), NumpyBackend(), NumbaBackend()):
+	registerBackend(_backend)
+
+
+def getBackend(backend=None):
+	'''
+	@params:
+		backend is a Backend, the name of a registered one, or None to read QR_BACKEND
+	returns the Backend, or None if none was asked for
+	'''
+	if backend is None:
+		backend = os.environ.get(BACKEND_VARIABLE) or None
+		if backend is None:
+			return None
+	if isinstance(backend, Backend):
+		return backend
+	if backend not in BACKENDS:
+		raise ValueError("unknown backend {!r}, expected one of {}".format(backend, ", ".join(sorted(BACKENDS))))
+	found = BACKENDS[backend]
+	if not found.available():
+		raise ValueError("backend {!r} is not available, its dependencies are not installed".format(backend))
+	return found
+
+
+def availableBackends():
+	'''
+	returns the names of the registered backends that can run here
+	'''
+	return [name for name, backend in BACKENDS.items() if backend.available()]
+
+
+def unmatchedCandidates(points, others, tolerance=1.0):
+	'''
+	@params:
+		points and others are PointArrays of candidates
+		tolerance is how far apart, in pixels, two candidates may be and still match
+	returns how many of points have none of others within tolerance
+	'''
+	if len(points) == 0:
+		return 0
+	if len(others) == 0:
+		return len(points)
+	#Bucket others into tolerance sized cells, any match is in a point's cell or a neighbour
+	cells = {}
+	for key, point in zip(map(tuple, np.floor(others.xy / tolerance).astype(np.int64).tolist()), others.xy):
+		cells.setdefault(key, []).append(point)
+	unmatched = 0
+	for (cx, cy), point in zip(np.floor(points.xy / tolerance).astype(np.int64).tolist(), points.xy):
+		near = [other for dx in (-1, 0, 1) for dy in (-1, 0, 1) for other in cells.get((cx + dx, cy + dy), ())]
+		if not any(np.hypot(*(other - point)) <= tolerance for other in near):
+			unmatched += 1
+	return unmatched
+
+
+def conformanceImages(test_dir=None, synthetic=2, seed=0):
+	'''
+	@params:
+		test_dir is a directory of images to check on, TestImages/ by default
+		synthetic is how many small synthetic scenes (see benchqr.makeScene) to add
+		seed seeds the synthetic scenes
+	returns a list of (name, RGB image) pairs
+	'''
+	import benchqr
+	test_dir = test_dir or os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "TestImages")
+	images = [(os.path.basename(path), Image.open(path).convert("RGB"))
+		for path in sorted(glob.glob(os.path.join(test_dir, "*")))]
+	images += [("synthetic-{}".format(index), benchqr.makeScene(0.1, index, seed).image)
+		for index in range(synthetic)]
+	return images
+
+
+def checkConformance(images, backends=None, reference="reference", num_vectors=4, leniency=.2,
+	tolerance=1.0, max_unmatched=.01):
+	'''
+	@params:
+		images is a list of (name, image) pairs, as from conformanceImages
+		backends is a list of backend names to check, every available one by default
+		reference is the backend the others are held to
+		num_vectors is how many directions to scan, as in myqr.getMassQRClusters
+		leniency is as in finderCandidates
+		tolerance is how far apart, in pixels, two candidates may be and still match
+		max_unmatched is the fraction of candidates that may go unmatched either way, for
+			the odd scanline that a rounding step lands on a different pixel
+	returns a list of dicts, one per image, direction and backend, with "ok" false where
+		the backend's candidates don't match the reference's
+	'''
+	import myqr
+	reference = getBackend(reference)
+	backends = [getBackend(name) for name in (backends or availableBackends())]
+	results = []
+	for name, image in images:
+		grid = ScanGrid(image)
+		for index in range(num_vectors):
+			theta = index*math.pi / num_vectors
+			vector = Point(math.cos(theta), math.sin(theta))
+			starts = myqr.scanStarts(grid.size, vector)
+			expected = reference.candidates(grid, vector, starts, leniency)
+			for backend in backends:
+				if backend is reference:
+					continue
+				found = backend.candidates(grid, vector, starts, leniency)
+				unmatched = (unmatchedCandidates(found, expected, tolerance)
+					+ unmatchedCandidates(expected, found, tolerance))
+				results.append({"image": name, "degrees": round(math.degrees(theta), 2),
+					"backend": backend.name, "candidates": len(found), "expected": len(expected),
+					"unmatched": unmatched,
+					"ok": unmatched <= max_unmatched * max(len(found) + len(expected), 1)})
+	return results
+
+
+def main(argv=None):
+	parser = argparse.ArgumentParser(description="List the detection backends, or check them against the reference.")
+	parser.add_argument("--check", action="store_true", help="check every backend's candidates against the reference")
+	parser.add_argument("--backend", action="append", help="backend to check, every available one by default")
+	parser.add_argument("--images", help="directory of images to check on, TestImages/ by default")
+	parser.add_argument("--synthetic", type=int, default=2, help="synthetic scenes to check on as well")
+	parser.add_argument("--vectors", type=int, default=4, help="scan directions per image")
+	args = parser.parse_args(argv)
+
+	for name, backend in BACKENDS.items():
+		print("{:<10} {}".format(name, "available" if backend.available() else "not installed"))
+	if not args.check:
+		return 0
+
+	results = checkConformance(conformanceImages(args.images, args.synthetic), args.backend,
+		num_vectors=args.vectors)
+	for result in results:
+		print("{:<4} {:<22} {:>6.2f} deg {:<8} {:6d} candidates, {:6d} expected, {} unmatched".format(
+			"ok" if result["ok"] else "FAIL", result["image"], result["degrees"], result["backend"],
+			result["candidates"], result["expected"], result["unmatched"]))
+	failed = sum(1 for result in results if not result["ok"])
+	print("{} of {} checks failed".format(failed, len(results)))
+	return 1 if failed else 0
+
+
+if __name__ == "__main__":
+	sys.exit(main())
@@ -0,0 +1,234 @@
+#!/usr/bin/env python3
+import hashlib
+import json
+import os
+import tempfile
+import threading
+from collections import OrderedDict
+
+
+class LRUCache:
+	'''
+	A bounded, thread-safe least-recently-used cache that counts its hits and misses.
+	Values are shared between callers, so they must never be changed in place.
+	'''
+	def __init__(self, maxsize, maxbytes=None, sizeof=None):
+		'''
+		@params:
+			maxsize is how many entries to keep before the oldest is evicted
+			maxbytes is how many bytes the entries may hold in all, as measured by
+				sizeof, before the oldest are evicted. None for no limit.
+			sizeof is called with a value and returns how many bytes it holds
+		'''
+		self.maxsize = maxsize
+		self.maxbytes = maxbytes
+		self.sizeof = sizeof
+		self.bytes = 0
+		self.hits = 0
+		self.misses = 0
+		self._entries = OrderedDict()
+		self._lock = threading.Lock()
+
+	def get(self, key, make):
+		'''
+		@params:
+			key is any hashable value identifying the entry
+			make is called with no arguments to build the entry when key is missing
+		returns the cached value for key, building and storing it first if needed
+		'''
+		with self._lock:
+			if key in self._entries:
+				self._entries.move_to_end(key)
+				self.hits += 1
+				return self._entries[key]
+			self.misses += 1
+		#Build outside the lock so one slow entry doesn't hold up every other thread
+		value = make()
+		with self._lock:
+			if key in self._entries: #another thread built it meanwhile
+				self.bytes -= self._size(self._entries[key])
+			self._entries[key] = value
+			self._entries.move_to_end(key)
+			self.bytes += self._size(value)
+			while len(self._entries) > self.maxsize or (self.maxbytes is not None and
+					self.bytes > self.maxbytes and len(self._entries) > 1):
+				key, evicted = self._entries.popitem(last=False)
+				self.bytes -= self._size(evicted)
+		return value
+
+	def peek(self, key):
+		'''
+		returns the cached value for key, or None if there is none. Neither a hit nor
+			a miss is counted, and nothing is built.
+		'''
+		with self._lock:
+			return self._entries.get(key)
+
+	def _size(self, value):
+		return self.sizeof(value) if self.sizeof is not None else 0
+
+	def clear(self):
+		with self._lock:
+			self._entries.clear()
+			self.bytes = 0
+			self.hits = 0
+			self.misses = 0
+
+	def __len__(self):
+		return len(self._entries)
+
+	def stats(self):
+		'''
+		returns a dict of the hits, misses, current size and maxsize of this cache, and
+			the bytes held if it is bounded by bytes
+		'''
+		with self._lock:
+			stats = {"hits": self.hits, "misses": self.misses,
+				"size": len(self._entries), "maxsize": self.maxsize}
+			if self.maxbytes is not None:
+				stats.update(bytes=self.bytes, maxbytes=self.maxbytes)
+			return stats
+
+
+class DiskCache:
+	'''
+	A size-bounded cache of JSON values in a directory, shared by every process that
+	opens the same directory. Entries are evicted least recently used first.
+
+	NOTE:
+	an entry is written to a temporary file and renamed into place, so readers in other
+	processes see either the whole entry or none of it, and no locking is needed. Two
+	processes missing the same key at once both build it, and the last rename wins.
+	Eviction goes by file modification times, which a hit bumps. Entries a concurrent
+	eviction has already removed are simply missed.
+	'''
+	def __init__(self, path, max_bytes=16*1024*1024):
+		'''
+		@params:
+			path is the directory to keep entries in, created if missing
+			max_bytes is how large the entries may grow in total before the least
+				recently used are removed
+		'''
+		self.path = path
+		self.max_bytes = max_bytes
+		self.hits = 0
+		self.misses = 0
+		#Bytes written since the directory was last measured, starting full so the first write measures it
+		self._written = max_bytes
+		os.makedirs(path, exist_ok=True)
+
+	def _file(self, key):
+		name = hashlib.sha256(key.encode("utf-8")).hexdigest()
+		return os.path.join(self.path, name[:2], name + ".json")
+
+	def get(self, key, make):
+		'''
+		@params:
+			key is a string identifying the entry
+			make is called with no arguments to build the entry when key is missing,
+				and has to return something json can store
+		returns the stored value for key, building and storing it first if needed
+		'''
+		value = self.lookup(key)
+		if value is None:
+			value = make()
+			self.store(key, value)
+		return value
+
+	def lookup(self, key):
+		'''
+		returns the stored value for key, or None if there is none. A stored None
+			can't be told apart from a miss.
+		'''
+		path = self._file(key)
+		try:
+			with open(path) as entry:
+				value = json.load(entry)
+		except (OSError, ValueError):
+			self.misses += 1
+			return None
+		try:
+			os.utime(path)
+		except OSError:
+			pass
+		self.hits += 1
+		return value
+
+	def store(self, key, value):
+		'''
+		stores value, which json has to be able to write, under key
+		'''
+		path = self._file(key)
+		text = json.dumps(value)
+		directory = os.path.dirname(path)
+		os.makedirs(directory, exist_ok=True)
+		handle, temporary = tempfile.mkstemp(dir=directory, suffix=".tmp")
+		try:
+			with os.fdopen(handle, "w") as entry:
+				entry.write(text)
+			os.replace(temporary, path)
+		except OSError:
+			try:
+				os.unlink(temporary)
+			except OSError:
+				pass
+			return
+		#Measuring the directory walks every entry, so only do it every tenth of the budget
+		self._written += len(text)
+		if self._written >= self.max_bytes // 10:
+			self._written = 0
+			self.evict()
+
+	def _entries(self):
+		'''
+		returns a list of (modification time, size, path) of every entry
+		'''
+		entries = []
+		for root, dirs, files in os.walk(self.path):
+			for name in files:
+				if not name.endswith(".json"):
+					continue
+				path = os.path.join(root, name)
+				try:
+					info = os.stat(path)
+				except OSError:
+					continue
+				entries.append((info.st_mtime, info.st_size, path))
+		return entries
+
+	def evict(self):
+		'''
+		removes the least recently used entries until they fit in nine tenths of max_bytes
+		'''
+		entries = self._entries()
+		total = sum(size for mtime, size, path in entries)
+		if total <= self.max_bytes:
+			return
+		for mtime, size, path in sorted(entries):
+			if total <= self.max_bytes * 9 // 10:
+				break
+			try:
+				os.unlink(path)
+			except OSError:
+				pass
+			total -= size
+
+	def clear(self):
+		for mtime, size, path in self._entries():
+			try:
+				os.unlink(path)
+			except OSError:
+				pass
+		self.hits = 0
+		self.misses = 0
+
+	def __len__(self):
+		return len(self._entries())
+
+	def stats(self):
+		'''
+		returns a dict of this process's hits and misses, and the entries and bytes on disk
+		'''
+		entries = self._entries()
+		return {"hits": self.hits, "misses": self.misses, "size": len(entries),
+			"bytes": sum(size for mtime, size, path in entries), "max_bytes": self.max_bytes}
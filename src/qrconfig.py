@@ -0,0 +1,160 @@
+#!/usr/bin/env python3
+import time
+from mathutil import MAX_CLUSTER_POINTS
+import qrtrace
+
+'''
+Detection settings gathered into one object, with named presets trading speed for recall.
+
+Usage:
+	pgram = myqr.scanImage2(image, config="fast")
+	image = myqr.insertQR(image, data, config=PRESETS["thorough"].replace(time_budget=2))
+
+NOTE:
+"balanced" is what scanImage2, findQR and insertQR do with no config, so passing it
+changes nothing. Arguments given to them explicitly win over the config. "fast" scans
+adaptively for modules of 3 pixels and up, clusters fewer candidates and gives up after a
+quarter of a second. It leaves the pyramid off: on benchqr's synthetic scenes the coarse
+pass hardly ever finds all three finders, so the full scan it falls back on runs anyway
+and the pyramid only adds 5-20% to it. It pays off on large, clean codes, 0.25s against
+0.70s for a 4000x4000 render of largeQRcode.png with pyramid_levels=3. "thorough" scans four directions in gather mode, adds the oriented rescan and
+clusters more candidates.
+
+a time budget is a hard per-image deadline on detection. Scanlines are scanned in
+interleaved bands, every few lines across the whole image first, and their scan tables
+are built band by band, so whenever time runs out the candidates so far cover the whole
+image and are clustered as usual. If fewer than three finder patterns were found by then,
+no code is found, as it isn't when they came from a run cut short and don't square up
+like a code's three finder patterns. Binarizing is checked strip by strip too (it takes
+about 0.7s of a 12MP image and 1.4s of a 24MP one in full). Only reading the image's
+pixels isn't cut short, so the budget can overrun by a few hundredths of a second on
+large images. Rendering and warping the new code are not counted. A deadline can't be kept across worker processes, so workers and a
+time budget together raise a ValueError.
+'''
+
+
+class Deadline:
+	'''
+	The time detection of one image has to stop by, and whether it got there.
+	'''
+	def __init__(self, seconds, bands=16):
+		'''
+		@params:
+			seconds is how long from now the deadline is
+			bands is the deadline_bands of DetectionConfig
+		'''
+		self.at = time.perf_counter() + seconds
+		self.bands = bands
+		self.reached = False
+
+	def passed(self):
+		'''
+		returns true once the deadline has gone by, which is then remembered in reached
+		'''
+		if not self.reached and time.perf_counter() >= self.at:
+			self.reached = True
+			qrtrace.count("deadlines_reached")
+		return self.reached
+
+
+class DetectionConfig:
+	'''
+	The knobs of detection. Build one with the defaults changed, or start from a preset
+	and replace what differs.
+	'''
+	def __init__(self, num_vectors=2, gather=False, threshold=50, leniency=.2, min_module=None,
+			pyramid_levels=0, max_regions=12, orient=False, binarize=False, max_points=MAX_CLUSTER_POINTS,
+			cluster_method="grid", box_size=4, time_budget=None, deadline_bands=16):
+		'''
+		@params:
+			num_vectors is how many directions to scan along
+			gather scans in table mode, see myqr.getMassQRClusters
+			threshold is the diffColors value neighbouring pixels must exceed to split a run
+			leniency is how far off the 1:1:3:1:1 ratio may be, as in kindaEquals
+			min_module is the smallest module, in pixels, to scan adaptively for. The
+				scanline stride is twice it, None scans every line.
+			pyramid_levels and max_regions are as in myqr.getPyramidQRClusters
+			orient adds the oriented rescan, see myqr.getOrientedQRClusters
+			binarize scans a thresholded copy, see binarizeImage
+			max_points caps how many candidates are clustered, see aggregatePoints
+			cluster_method is the method of constructParallelograms
+			box_size is how many pixels wide each module of a rendered code is
+			time_budget is how many seconds detection may take per image, None for no limit
+			deadline_bands is how many interleaved bands the scanlines are split into
+				when there is a time budget. More bands check the clock more often.
+		'''
+		self.num_vectors = num_vectors
+		self.gather = gather
+		self.threshold = threshold
+		self.leniency = leniency
+		self.min_module = min_module
+		self.pyramid_levels = pyramid_levels
+		self.max_regions = max_regions
+		self.orient = orient
+		self.binarize = binarize
+		self.max_points = max_points
+		self.cluster_method = cluster_method
+		self.box_size = box_size
+		self.time_budget = time_budget
+		self.deadline_bands = deadline_bands
+
+	def replace(self, **changes):
+		'''
+		returns a copy of this config with changes applied
+		'''
+		unknown = set(changes) - set(vars(self))
+		if unknown:
+			raise TypeError("unknown detection settings: {}".format(", ".join(sorted(unknown))))
+		return DetectionConfig(**dict(vars(self), **changes))
+
+	def deadline(self):
+		'''
+		returns the Deadline for detection starting now, or None if there is no time budget
+		'''
+		if self.time_budget is None:
+			return None
+		return Deadline(self.time_budget, self.deadline_bands)
+
+	def key(self):
+		'''
+		returns the settings that change detection results, for keying caches. A
+			cluster_method function is named by its module and qualified name, since its
+			repr holds an address that differs from run to run.
+		raises ValueError if cluster_method is a lambda or a nested function, which have
+			no name that tells them apart from others like them
+		'''
+		key = dict(vars(self))
+		del key["box_size"], key["deadline_bands"]
+		method = self.cluster_method
+		if callable(method):
+			name = getattr(method, "__qualname__", "<unnamed>")
+			if "<" in name:
+				raise ValueError("can't key a cache by cluster_method {!r}, give it a module level function".format(method))
+			key["cluster_method"] = "{}.{}".format(method.__module__, name)
+		return tuple(sorted(key.items()))
+
+	def __repr__(self):
+		return "DetectionConfig({})".format(", ".join("{}={!r}".format(k, v) for k, v in vars(self).items()))
+
+
+PRESETS = {
+	"fast": DetectionConfig(min_module=3, max_points=20000, time_budget=.25),
+	"balanced": DetectionConfig(),
+	"thorough": DetectionConfig(num_vectors=4, gather=True, orient=True, max_regions=None,
+		max_points=4*MAX_CLUSTER_POINTS),
+}
+
+
+def getConfig(config=None):
+	'''
+	@params:
+		config is a DetectionConfig, the name of a preset, or None for "balanced"
+	returns the DetectionConfig
+	'''
+	if config is None:
+		return PRESETS["balanced"]
+	if isinstance(config, DetectionConfig):
+		return config
+	if config not in PRESETS:
+		raise ValueError("unknown preset {!r}, expected one of {}".format(config, ", ".join(sorted(PRESETS))))
+	return PRESETS[config]
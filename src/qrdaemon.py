@@ -0,0 +1,326 @@
+#!/usr/bin/env python3
+import argparse
+import json
+import os
+import signal
+import socket
+import socketserver
+import sys
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import resource_tracker, shared_memory
+import numpy as np
+from PIL import Image
+
+'''
+A long running server that keeps warm worker processes for detect and insert jobs.
+
+Usage:
+	qrdaemon.py --socket /tmp/qr.sock --workers 4
+	qrdaemon.py --stdin < requests.jsonl > responses.jsonl
+
+Requests and responses are JSON objects, one per line. A request has an "op" and
+an optional "id" that is copied into its response, since responses come back in
+the order jobs finish rather than the order they were sent:
+
+	{"id": 1, "op": "detect", "path": "photo.jpg"}
+	{"id": 2, "op": "insert", "path": "photo.jpg", "output": "out.png", "data": "https://example.com"}
+	{"id": 3, "op": "insert", "shm": "psm_1234", "shape": [1080, 1920, 3], "data": ["a", "b"]}
+	{"id": 4, "op": "find", "path": "poster.png"}
+	{"op": "ping"}  {"op": "stats"}
+
+A response is {"id": ..., "ok": true, "result": ..., "seconds": ...}, or has "ok": false
+and an "error" instead.
+
+NOTE:
+images are passed by "path", or by "shm", the name of a shared memory block holding
+a (height, width, 3) uint8 array of the given "shape". Pixels never go through the
+socket. An insert on a shared memory image writes the result back into the block.
+
+detect, find and insert take the options of myqr.scanImage2, findQR and insertQR
+("binarize", "pyramid_levels", "min_module", "perspective") as extra fields, and
+"config", the name of a qrconfig preset. A detect that finds no code has a null result.
+
+at most max_inflight requests run at once across every connection. Past that the
+daemon stops reading requests, so callers sending too fast block instead of
+piling up work in memory.
+'''
+
+
+def attachShared(name):
+	'''
+	returns the SharedMemory block called name, without this process taking ownership of it
+	'''
+	try:
+		return shared_memory.SharedMemory(name=name, track=False)
+	except TypeError: #track is 3.13+
+		block = shared_memory.SharedMemory(name=name)
+		#Before 3.13 attaching registers the block with our resource tracker, which would unlink it when we exit
+		resource_tracker.unregister(block._name, "shared_memory")
+		return block
+
+
+def warmWorker(payloads):
+	'''
+	Runs once in every worker. Loads the pipeline and renders payloads ahead of time,
+	so the first real requests find the imports and code bitmaps ready.
+	'''
+	import myqr
+	for data in payloads:
+		myqr.makeQRImage(data)
+
+
+def options(request, names):
+	return {name: request[name] for name in names if name in request}
+
+
+def runRequest(request):
+	'''
+	Runs in a worker.
+	returns the result of request, raising if it can't be done
+	'''
+	import myqr
+	op = request.get("op")
+	if op == "ping":
+		return {"pid": os.getpid()}
+	if op == "stats":
+		return myqr.cacheStats()
+	if op not in ("detect", "find", "insert"):
+		raise ValueError("unknown op {!r}".format(op))
+
+	block = pixels = None
+	if "shm" in request:
+		block = attachShared(request["shm"])
+		pixels = np.ndarray(tuple(request["shape"]), dtype=np.uint8, buffer=block.buf)
+		image = Image.fromarray(pixels)
+	else:
+		image = Image.open(request["path"]).convert("RGB")
+	try:
+		if op == "detect":
+			pgram = myqr.scanImage2(image, **options(request, ("binarize", "pyramid_levels", "min_module", "config")))
+			return [p.asTuple() for p in pgram] if pgram is not None else None
+		if op == "find":
+			pgrams = myqr.findQR(image, **options(request, ("binarize", "pyramid_levels", "min_module", "config")))
+			return [[p.asTuple() for p in pgram] for pgram in pgrams]
+		result = myqr.insertQR(image, request["data"], **options(request, ("perspective", "binarize", "config")))
+		if pixels is not None:
+			pixels[:] = np.asarray(result)
+			return {"shm": request["shm"]}
+		result.save(request["output"])
+		return {"output": request["output"]}
+	finally:
+		if block is not None:
+			image = pixels = None #views into block have to go before it can close
+			block.close()
+
+
+class QRDaemon:
+	'''
+	A pool of warm workers and the limit on how many requests they are given at once.
+	'''
+	def __init__(self, workers=None, max_inflight=None, warm_payloads=()):
+		'''
+		@params:
+			workers is the number of worker processes, defaulting to the number of cores
+			max_inflight is how many requests may be queued or running at once, 4 per
+				worker by default, so every worker has its next job waiting
+			warm_payloads are payloads to render in every worker up front
+		'''
+		self.workers = workers or os.cpu_count() or 1
+		self.max_inflight = max_inflight or 4*self.workers
+		self.slots = threading.BoundedSemaphore(self.max_inflight)
+		self.pool = ProcessPoolExecutor(self.workers, initializer=warmWorker,
+			initargs=(tuple(warm_payloads),))
+		#Start every worker now rather than on the first requests
+		for future in [self.pool.submit(runRequest, {"op": "ping"}) for i in range(self.workers)]:
+			future.result()
+
+	def close(self):
+		self.pool.shutdown()
+
+	def submit(self, request, reply):
+		'''
+		@params:
+			request is a request dict
+			reply is called with the response dict, from another thread, once it is done
+		blocks until fewer than max_inflight requests are running, then hands request on
+		'''
+		self.slots.acquire()
+		start = time.perf_counter()
+
+		def done(future):
+			self.slots.release()
+			response = {"id": request.get("id")}
+			try:
+				response.update(ok=True, result=future.result())
+			except Exception as e:
+				response.update(ok=False, error="{}: {}".format(type(e).__name__, e))
+			response["seconds"] = time.perf_counter() - start
+			reply(response)
+
+		try:
+			future = self.pool.submit(runRequest, request)
+		except Exception:
+			self.slots.release()
+			raise
+		future.add_done_callback(done)
+
+	def serveLines(self, lines, write):
+		'''
+		@params:
+			lines is an iterable of request lines, read only as fast as slots free up
+			write is called with each response line
+		returns once every request from lines has been answered
+		'''
+		lock = threading.Condition()
+		pending = [0]
+
+		def reply(response):
+			with lock:
+				try:
+					write(json.dumps(response) + "\n")
+				except OSError:
+					pass #the reader went away, still count the request as answered
+				pending[0] -= 1
+				lock.notify_all()
+
+		for line in lines:
+			if not line.strip():
+				continue
+			try:
+				request = json.loads(line)
+				if not isinstance(request, dict):
+					raise ValueError("a request has to be a JSON object")
+			except ValueError as e:
+				with lock:
+					write(json.dumps({"id": None, "ok": False, "error": "ValueError: {}".format(e)}) + "\n")
+				continue
+			with lock:
+				pending[0] += 1
+			try:
+				self.submit(request, reply)
+			except Exception as e: #the pool is broken or shut down
+				reply({"id": request.get("id"), "ok": False, "error": "{}: {}".format(type(e).__name__, e)})
+		with lock:
+			while pending[0]:
+				lock.wait()
+
+
+class _ConnectionHandler(socketserver.StreamRequestHandler):
+	def handle(self):
+		lines = (line.decode("utf-8") for line in self.rfile)
+
+		def write(text):
+			self.wfile.write(text.encode("utf-8"))
+			self.wfile.flush()
+
+		try:
+			self.server.daemon.serveLines(lines, write)
+		except (BrokenPipeError, ConnectionResetError):
+			pass #the client went away, its results have nowhere to go
+
+
+class _UnixServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+	daemon_threads = True
+
+
+def serveSocket(daemon, path):
+	'''
+	serves daemon on a Unix domain socket at path until interrupted
+	'''
+	if os.path.exists(path):
+		os.unlink(path)
+	server = _UnixServer(path, _ConnectionHandler)
+	server.daemon = daemon
+	try:
+		server.serve_forever()
+	finally:
+		server.server_close()
+		os.unlink(path)
+
+
+class QRClient:
+	'''
+	A connection to a daemon's socket. Use send and receive to keep several requests in
+	flight at once, or call for one at a time.
+	'''
+	def __init__(self, path):
+		self.socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+		self.socket.connect(path)
+		self.reader = self.socket.makefile("r", encoding="utf-8")
+		self.next_id = 0
+
+	def close(self):
+		self.reader.close()
+		self.socket.close()
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *exc):
+		self.close()
+
+	def send(self, op, **fields):
+		'''
+		sends a request without waiting for it
+		returns its id
+		'''
+		self.next_id += 1
+		request = dict(fields, op=op, id=self.next_id)
+		self.socket.sendall((json.dumps(request) + "\n").encode("utf-8"))
+		return self.next_id
+
+	def receive(self):
+		'''
+		returns the next response to arrive, whichever request it answers
+		'''
+		return json.loads(self.reader.readline())
+
+	def call(self, op, **fields):
+		'''
+		returns the result of one request, raising RuntimeError if it failed.
+		Don't mix with send while other requests are in flight.
+		'''
+		self.send(op, **fields)
+		response = self.receive()
+		if not response["ok"]:
+			raise RuntimeError(response["error"])
+		return response["result"]
+
+
+def main(argv=None):
+	parser = argparse.ArgumentParser(description="Serve QR detect and insert requests from warm workers.")
+	parser.add_argument("--socket", help="Unix domain socket to listen on")
+	parser.add_argument("--stdin", action="store_true", help="read requests from stdin, answer on stdout")
+	parser.add_argument("--workers", type=int, help="worker processes, one per core by default")
+	parser.add_argument("--max-inflight", type=int, help="requests allowed to run at once")
+	parser.add_argument("--warm", action="append", default=[], help="payload to render in every worker up front")
+	args = parser.parse_args(argv)
+	if bool(args.socket) == args.stdin:
+		parser.error("give exactly one of --socket and --stdin")
+
+	daemon = QRDaemon(args.workers, args.max_inflight, args.warm)
+	#A service manager stops the daemon with SIGTERM, clean up as on ^C. The workers are
+	#already running, so they keep the default handler.
+	def interrupt(signum, frame):
+		raise KeyboardInterrupt
+	signal.signal(signal.SIGTERM, interrupt)
+	try:
+		if args.stdin:
+			def write(text):
+				sys.stdout.write(text)
+				sys.stdout.flush()
+			daemon.serveLines(sys.stdin, write)
+		else:
+			sys.stderr.write("serving on {} with {} workers\n".format(args.socket, daemon.workers))
+			serveSocket(daemon, args.socket)
+	except KeyboardInterrupt:
+		pass
+	finally:
+		daemon.close()
+	return 0
+
+
+if __name__ == "__main__":
+	sys.exit(main())
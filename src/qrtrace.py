@@ -0,0 +1,210 @@
+#!/usr/bin/env python3
+import functools
+import json
+import sys
+import time
+import tracemalloc
+
+'''
+Opt-in timing and counters for the detection pipeline.
+
+Usage:
+	with tracing() as trace:
+		myqr.insertQR(image, data)
+	print(trace.report())
+
+	with tracing(sink=JSONLinesSink("trace.jsonl"), memory=True):
+		...
+
+NOTE:
+a stage is a traced function (see traced). Each stage's calls, total and longest
+duration and, when tracing with memory=True, its tracemalloc allocation peak are
+kept by name. Counters are named totals bumped with count, such as how many
+scanlines or candidates were looked at.
+
+Nothing is recorded unless a tracing block is open. Blocks are per process, not per
+thread, so keep to one at a time when threads share the pipeline. When off, a traced
+function costs one global lookup on top of its call. Work done in other processes
+(see parallelscan) is not seen.
+'''
+
+#The Trace being recorded into, None when tracing is off
+_trace = None
+
+
+class Trace:
+	'''
+	The stage timings and counters recorded by one tracing block.
+	'''
+	def __init__(self, memory=False):
+		'''
+		@params:
+			memory records each stage's allocation peak with tracemalloc, which slows
+				everything down a good deal while it is on
+		'''
+		self.memory = memory
+		self.stages = {}
+		self.counters = {}
+		self._peaks = [] #running allocation peak of each open stage, innermost last
+
+	def count(self, name, amount=1):
+		self.counters[name] = self.counters.get(name, 0) + amount
+
+	def enter(self):
+		'''
+		returns the state stage needs at exit
+		'''
+		if self.memory:
+			current, peak = tracemalloc.get_traced_memory()
+			if self._peaks:
+				self._peaks[-1] = max(self._peaks[-1], peak)
+			tracemalloc.reset_peak()
+			self._peaks.append(current)
+			return time.perf_counter(), current
+		return time.perf_counter(), None
+
+	def exit(self, name, state):
+		'''
+		adds one call of stage name, begun at state from enter, to the record
+		'''
+		start, base = state
+		seconds = time.perf_counter() - start
+		stage = self.stages.get(name)
+		if stage is None:
+			stage = self.stages[name] = {"calls": 0, "seconds": 0.0, "max_seconds": 0.0}
+		stage["calls"] += 1
+		stage["seconds"] += seconds
+		stage["max_seconds"] = max(stage["max_seconds"], seconds)
+		if base is not None:
+			peak = max(self._peaks.pop(), tracemalloc.get_traced_memory()[1])
+			stage["peak_bytes"] = max(stage.get("peak_bytes", 0), peak - base)
+			if self._peaks: #an enclosing stage saw this peak too
+				self._peaks[-1] = max(self._peaks[-1], peak)
+
+	def report(self):
+		'''
+		returns a dict of the stages and counters, ready for json
+		'''
+		return {"stages": {name: dict(stage) for name, stage in self.stages.items()},
+			"counters": dict(self.counters)}
+
+	def __str__(self):
+		lines = []
+		for name, stage in sorted(self.stages.items(), key=lambda item: -item[1]["seconds"]):
+			line = "{:<28} {:5d} calls {:10.4f}s".format(name, stage["calls"], stage["seconds"])
+			if "peak_bytes" in stage:
+				line += " {:10.1f}KiB peak".format(stage["peak_bytes"] / 1024)
+			lines.append(line)
+		lines += ["{:<28} {}".format(name, value) for name, value in sorted(self.counters.items())]
+		return "\n".join(lines)
+
+
+class tracing:
+	'''
+	A context manager that records into a new Trace for the duration of the block.
+	'''
+	def __init__(self, sink=None, memory=False):
+		'''
+		@params:
+			sink is called with the Trace's report when the block ends, see the sinks below
+			memory is as in Trace
+		'''
+		self.sink = sink
+		self.trace = Trace(memory)
+		self._outer = None
+		self._started_tracemalloc = False
+
+	def __enter__(self):
+		global _trace
+		if self.trace.memory and not tracemalloc.is_tracing():
+			tracemalloc.start()
+			self._started_tracemalloc = True
+		self._outer = _trace
+		_trace = self.trace
+		return self.trace
+
+	def __exit__(self, *exc):
+		global _trace
+		_trace = self._outer
+		if self._started_tracemalloc:
+			tracemalloc.stop()
+		if self.sink is not None:
+			self.sink(self.trace.report())
+
+
+def traced(name=None):
+	'''
+	@params:
+		name is the stage to record the function's calls under, its own name by default
+	returns a decorator timing every call of a function as a stage while tracing is on
+	'''
+	def decorate(function):
+		stage = name or function.__name__
+
+		@functools.wraps(function)
+		def wrapper(*args, **kwargs):
+			trace = _trace
+			if trace is None:
+				return function(*args, **kwargs)
+			state = trace.enter()
+			try:
+				return function(*args, **kwargs)
+			finally:
+				trace.exit(stage, state)
+		return wrapper
+	return decorate
+
+
+def count(name, amount=1):
+	'''
+	adds amount to counter name of the open Trace, if any
+	'''
+	if _trace is not None:
+		_trace.count(name, amount)
+
+
+def tracingEnabled():
+	return _trace is not None
+
+
+#Sinks, anything taking a report dict will do
+
+def printSink(report, stream=None):
+	'''
+	writes report to stream (stderr by default) as an aligned table
+	'''
+	stream = stream or sys.stderr
+	for name, stage in report["stages"].items():
+		stream.write("{:<28} {:5d} calls {:10.4f}s\n".format(name, stage["calls"], stage["seconds"]))
+	for name, value in report["counters"].items():
+		stream.write("{:<28} {}\n".format(name, value))
+
+
+class JSONLinesSink:
+	'''
+	appends each report to a file as one line of JSON
+	'''
+	def __init__(self, path, **extra):
+		'''
+		@params:
+			path is the file to append to
+			extra is added to every line, eg an image name
+		'''
+		self.path = path
+		self.extra = extra
+
+	def __call__(self, report):
+		with open(self.path, "a") as output:
+			output.write(json.dumps(dict(self.extra, **report)) + "\n")
+
+
+class LoggingSink:
+	'''
+	logs each report as one record of a logging.Logger
+	'''
+	def __init__(self, logger, level=20):
+		self.logger = logger
+		self.level = level
+
+	def __call__(self, report):
+		self.logger.log(self.level, "qr trace %s", json.dumps(report))
@@ -0,0 +1,710 @@
+#!/usr/bin/env python3
+import math
+import numpy as np
+from PIL import Image
+from mathobjects import *
+from qrcache import LRUCache
+
+'''
+NOTE:
+a pixel array is a NumPy int16 array shaped (height, width, channels), made once per image
+so scans never have to go back through PIL's getpixel
+
+a break array is a boolean array where True marks a pair of neighbouring pixels whose
+diffColors is above the threshold, ie the place where getColorGroups splits a Segment
+
+run arrays are (line_ids, segments) where segments is a SegmentArray holding each run's
+first and last pixel and line_ids says which scanline each run lies on. Runs of one scanline
+are contiguous and in scan order, so a run array is many getColorGroups results laid end to end.
+'''
+
+#How many scan tables angleScanTable and spacedScanTable keep between them, and how many
+#bytes. A table of a 4000x3000 image is ~70MB, so the bytes are what usually binds.
+SCAN_TABLE_CACHE_SIZE = 16
+SCAN_TABLE_CACHE_BYTES = 256 << 20
+SCAN_TABLE_CACHE = LRUCache(SCAN_TABLE_CACHE_SIZE, SCAN_TABLE_CACHE_BYTES, lambda table: table.nbytes)
+
+
+def imageToArray(image):
+	'''
+	@params:
+		image is the PIL image to convert
+	returns the pixels of image as an int16 array shaped (height, width, channels).
+		int16 leaves room for the signed differences diffColors takes.
+	'''
+	pixels = np.asarray(image, dtype=np.int16)
+	if pixels.ndim == 2: #single band images still get a channel axis
+		pixels = pixels[:, :, np.newaxis]
+	return pixels
+
+
+def paddedIntegral(plane, radius, strip=256, deadline=None):
+	'''
+	@params:
+		plane is a 2d array of non-negative integers
+		radius is half the side of the boxes that will be summed, as in boxSums
+		strip is how many rows are summed at a time, each strip carrying on from the
+			last row of the one before
+		deadline is a qrconfig.Deadline checked before every strip, None to not stop
+	returns the int64 integral image of plane, edge padded by radius on every side so that
+		the box around any pixel, clipped to the plane, is a plain slice. Entry
+		(radius+1+y, radius+1+x) is the sum of plane[:y+1, :x+1]; the rows and columns
+		before the plane are 0 and those past it repeat its last.
+		None if the deadline passed first.
+	'''
+	height, width = plane.shape
+	first = radius + 1
+	integral = np.zeros((height + 2*radius + 1, width + 2*radius + 1), dtype=np.int64)
+	inner = integral[first:first + height, first:first + width]
+	for top in range(0, height, strip):
+		if deadline is not None and deadline.passed():
+			return None
+		rows = inner[top:top + strip]
+		np.cumsum(plane[top:top + strip], axis=1, dtype=np.int64, out=rows)
+		np.cumsum(rows, axis=0, out=rows)
+		if top:
+			rows += inner[top - 1]
+	integral[first + height:, first:first + width] = inner[-1]
+	integral[:, first + width:] = integral[:, first + width - 1:first + width]
+	return integral
+
+
+def boxSums(integral, radius, top, bottom):
+	'''
+	@params:
+		integral is a paddedIntegral of the plane, made with the same radius
+		radius is half the side of the box, the box is 2*radius+1 wide
+		top and bottom are the plane rows to sum for, bottom excluded
+	returns the sum of the plane over the box around every pixel of those rows, the box
+		clipped to the plane. Four slices of the integral image, so the cost doesn't
+		depend on radius.
+	'''
+	side = 2*radius + 1
+	width = integral.shape[1] - side
+	below = integral[top + side:bottom + side]
+	above = integral[top:bottom]
+	return below[:, side:] - above[:, side:] - below[:, :width] + above[:, :width]
+
+
+def boxAreas(length, radius):
+	'''
+	returns how many of length positions the 2*radius+1 wide box around each of them
+		covers, once clipped to the ends
+	'''
+	positions = np.arange(length)
+	return np.minimum(positions + radius + 1, length) - np.maximum(positions - radius, 0)
+
+
+def noiseLevel(plane, step=4):
+	'''
+	@params:
+		plane is a 2d uint8 array
+		step is how many rows apart the sampled rows are
+	returns an estimate of the standard deviation of the pixel noise in plane, from the
+		median difference between horizontal neighbours. Edges are too few to move the
+		median, so it is the noise rather than the picture that sets it.
+	'''
+	steps = np.abs(np.diff(plane[::step].astype(np.int16), axis=1))
+	if steps.size == 0:
+		return 0.0
+	#The difference of two samples of N(0, s) is N(0, s*sqrt(2)), whose median size is .6745 of that
+	return float(np.median(steps)) / (.6745*math.sqrt(2))
+
+
+def localSums(plane, radius, top, bottom):
+	'''
+	@params:
+		plane is a 2d array of non-negative integers, small enough that (2*radius+1)**2
+			of them fit an int32
+		radius is half the side of the box, the box is 2*radius+1 wide
+		top and bottom are the plane rows to sum for, bottom excluded
+	returns the int32 sum of plane over the box around every pixel of those rows, the
+		box clipped to the plane, like boxSums. For small boxes adding up shifted slices,
+		rows then columns, is quicker than an integral image and needs no more memory
+		than the strip.
+	'''
+	height, width = plane.shape
+	columns = np.zeros((bottom - top, width), dtype=np.int32)
+	for dy in range(-radius, radius + 1):
+		first, last = max(top, -dy), min(bottom, height - dy)
+		columns[first - top:last - top] += plane[first + dy:last + dy]
+	sums = columns.copy()
+	for dx in range(1, radius + 1):
+		sums[:, :width - dx] += columns[:, dx:]
+		sums[:, dx:] += columns[:, :width - dx]
+	return sums
+
+
+def binarizeImage(image, window=None, offset=10, min_contrast=8, strip=256, smooth=3, edge_noise=4,
+		majority=1, sauvola=.5, dynamic_range=128, deadline=None):
+	'''
+	@params:
+		image is the PIL image to binarize
+		window is the side of the box each pixel is compared against, an eighth of the
+			image's larger side if not given
+		offset is how far below the local threshold a pixel must be to count as dark
+		min_contrast is the local standard deviation below which a box is taken to be
+			one flat color, raised to three times the image's noise level when that is
+			higher. A flat box is dark or light as a whole, by its mean against the
+			whole image's.
+		strip is how many rows are thresholded at a time, to bound the memory used
+		smooth is half the side of the small box a pixel is averaged over when it isn't
+			near an edge, 0 to threshold every pixel as it is
+		edge_noise is how many times the noise level the small box's standard deviation
+			must reach for its pixel to be taken as near an edge and kept as it is
+		majority is half the side of the box whose majority each binarized pixel is
+			replaced by at the end, 0 to leave the pixels alone
+		sauvola and dynamic_range lower the threshold from the local mean to
+			mean*(1 + sauvola*(deviation/dynamic_range - 1)), as Sauvola's method does;
+			0 thresholds at the mean
+		deadline is a qrconfig.Deadline checked before every strip, None to not stop
+	returns a PIL "L" image that is 0 where image is dark and 255 elsewhere.
+		The image is reduced once to a uint8 luminance plane and every pixel is thresholded
+		against the mean of its neighbourhood, so uneven lighting and soft edges no longer
+		make extra runs. Where a code sits on a light background the mean is well above
+		halfway between its dark and light modules, and blurred light rings between dark
+		ones would come out thin, so the threshold drops with the local contrast. Sensor noise would turn every stretch of background near that
+		mean into speckle, whose runs fake finder patterns, so away from edges the
+		pixels are averaged before thresholding and the majority filter clears what
+		speckle is left. Edges, and the modules of a code, are kept sharp. Scanning the
+		result only has one band to read.
+		None if the deadline passed first.
+	'''
+	plane = np.asarray(image.convert("L"))
+	if window is None:
+		window = max(max(image.size) // 8, 15)
+	radius = window // 2
+	height, width = plane.shape
+	noise = noiseLevel(plane)
+	min_contrast = max(min_contrast, 3*noise)
+
+	sum_integral = paddedIntegral(plane, radius, strip, deadline)
+	#255**2 still fits a uint16, the integral is what needs the width
+	squares_plane = np.square(plane, dtype=np.uint16)
+	square_integral = paddedIntegral(squares_plane, radius, strip, deadline)
+	if sum_integral is None or square_integral is None:
+		return None
+	heights = boxAreas(height, radius)[:, np.newaxis]
+	widths = boxAreas(width, radius)[np.newaxis, :]
+	small_heights = boxAreas(height, smooth)[:, np.newaxis]
+	small_widths = boxAreas(width, smooth)[np.newaxis, :]
+	mean = plane.mean()
+	dark = np.empty((height, width), dtype=np.uint8)
+	for top in range(0, height, strip):
+		if deadline is not None and deadline.passed():
+			return None
+		bottom = min(top + strip, height)
+		rows = plane[top:bottom]
+		if smooth > 0:
+			small_sums = localSums(plane, smooth, top, bottom)
+			small_squares = localSums(squares_plane, smooth, top, bottom)
+			small_areas = small_heights[top:bottom] * small_widths
+			#area**2 times the variance, as below
+			edge = small_squares*small_areas - small_sums**2 >= (edge_noise*noise*small_areas)**2
+			rows = np.where(edge, rows, small_sums / small_areas)
+		sums = boxSums(sum_integral, radius, top, bottom)
+		squares = boxSums(square_integral, radius, top, bottom)
+		areas = heights[top:bottom] * widths
+		variance_areas = squares*areas - sums**2 #area**2 times the variance
+		#Compare in sums rather than means, it saves dividing by every area
+		deviations = np.sqrt(variance_areas) / areas
+		strip_dark = rows*areas < sums*(1 + sauvola*(deviations/dynamic_range - 1)) - offset*areas
+		flat = variance_areas < (min_contrast*areas)**2
+		strip_dark[flat] = (sums < mean*areas)[flat]
+		dark[top:bottom] = strip_dark
+	del sum_integral, square_integral, squares_plane #done with, before the second pass
+
+	binary = np.empty((height, width), dtype=np.uint8)
+	majority_heights = boxAreas(height, majority)[:, np.newaxis]
+	majority_widths = boxAreas(width, majority)[np.newaxis, :]
+	for top in range(0, height, strip):
+		if deadline is not None and deadline.passed():
+			return None
+		bottom = min(top + strip, height)
+		if majority > 0:
+			areas = majority_heights[top:bottom] * majority_widths
+			strip_dark = 2*localSums(dark, majority, top, bottom) > areas
+		else:
+			strip_dark = dark[top:bottom].astype(bool)
+		binary[top:bottom] = np.where(strip_dark, 0, 255)
+	return Image.fromarray(binary)
+
+
+def colorBreaks(pixels, axis, threshold=50):
+	'''
+	@params:
+		pixels is a pixel array
+		axis is 0 to compare each pixel with the one below it, 1 for the one to its right
+		threshold is the diffColors value a pair must exceed to be split
+	returns a break array, one element shorter than pixels along axis.
+		This is diffColors for every neighbouring pair at once.
+	'''
+	delta = np.abs(np.diff(pixels, axis=axis)).sum(axis=2)
+	return delta > threshold
+
+
+def axisDirection(direction, tolerance=1e-9):
+	'''
+	@params:
+		direction is a point (vector) defining direction to travel
+		tolerance is how far off a unit axis vector direction may be
+	returns the integer unit vector direction points along, or None if it is not axis-aligned.
+		cos/sin leave crumbs like 6e-17 on vectors that should be (0,1); those crumbs never
+		move a truncated pixel coordinate, so they are rounded away here.
+	'''
+	dx = round(direction.x)
+	dy = round(direction.y)
+	if abs(dx) + abs(dy) != 1:
+		return None
+	if abs(direction.x - dx) > tolerance or abs(direction.y - dy) > tolerance:
+		return None
+	return Point(int(dx), int(dy))
+
+
+def maskRuns(ends, offsets, origins, direction):
+	'''
+	@params:
+		ends is a boolean array over the samples of many scanlines laid end to end,
+			True where a run stops (every scanline's last sample must be True)
+		offsets says scanline i owns samples offsets[i]:offsets[i+1]
+		origins is an (n,2) array with the (x,y) of each scanline's first sample
+		direction is the (dx,dy) step between samples
+	returns the run array those ends describe
+	'''
+	run_ends = np.flatnonzero(ends)
+	run_starts = np.concatenate(([0], run_ends[:-1] + 1)).astype(run_ends.dtype)
+	line_ids = np.searchsorted(offsets, run_starts, side="right") - 1
+	step = np.asarray(direction, dtype=np.float64)
+
+	def samplePoints(positions):
+		steps = (positions - offsets[line_ids])[:, np.newaxis]
+		return PointArray(origins[line_ids] + steps*step)
+
+	return line_ids, SegmentArray(samplePoints(run_starts), samplePoints(run_ends))
+
+
+def finderCandidates(line_ids, segments, leniency=.2):
+	'''
+	@params:
+		line_ids, segments is a run array
+		leniency is how lenient to be, as in kindaEquals
+	returns a PointArray with the midpoint of every run that is the center of
+		five consecutive runs of one scanline in the QR code ratio 1:1:3:1:1.
+		Same test as myqr.matchFinderPattern, done for every window of every scanline at once.
+	'''
+	if len(line_ids) < 5:
+		return PointArray([])
+	lengths = segments.length()
+	num_windows = len(lengths) - 4
+	#Window i is runs i..i+4, and only counts if they all lie on one scanline
+	same_line = line_ids[:num_windows] == line_ids[4:]
+
+	base_len = lengths[:num_windows]
+	n2_max = base_len*(1 + leniency)
+	n2_min = base_len*(1 - leniency)
+	matches = same_line
+	for offset in range(1, 5):
+		length = lengths[offset:offset + num_windows]
+		if offset == 2: #ratio is 1:1:3:1:1, so scale the 3 down to a 1
+			length = length/3
+		matches = matches & ((length == base_len) | ((length < n2_max) & (length > n2_min)))
+
+	centers = np.flatnonzero(matches) + 2
+	return segments[centers].midpoint()
+
+
+class ScanGrid:
+	'''
+	The pixels of an image copied into a pixel array once, along with the break arrays
+	for its rows and columns. Has a size and getpixel like a PIL image, so it can be passed
+	anywhere the scanning functions in myqr expect one.
+	'''
+	def __init__(self, image, threshold=50):
+		'''
+		@params:
+			image is a PIL image, or a pixel array that is used as is (not copied)
+			threshold is the diffColors value a pair must exceed to be split
+		'''
+		if isinstance(image, np.ndarray):
+			self.pixels = image
+			self.size = (image.shape[1], image.shape[0])
+		else:
+			self.pixels = imageToArray(image)
+			self.size = image.size
+		self.threshold = threshold
+		self._breaks = {}
+
+	def getpixel(self, xy):
+		'''
+		@params:
+			xy is an (x,y) tuple, truncated to whole pixels the same way PIL does
+		returns the color-tuple at xy
+		'''
+		return tuple(self.pixels[int(xy[1]), int(xy[0])].tolist())
+
+	def breaks(self, axis):
+		'''
+		@params:
+			axis is 0 for columns, 1 for rows
+		returns the break array for axis, computing it on first use
+		'''
+		if axis not in self._breaks:
+			self._breaks[axis] = colorBreaks(self.pixels, axis, self.threshold)
+		return self._breaks[axis]
+
+	def lineBreaks(self, axis, indices):
+		'''
+		@params:
+			axis is 0 for columns, 1 for rows
+			indices is an array of the columns or rows wanted
+		returns a 2d array with the break array of each of those lines as a row. Unless
+			most of the lines are wanted, only they are diffed, so a band of scanlines
+			under a deadline doesn't wait on the whole grid.
+		'''
+		if axis not in self._breaks and 2*len(indices) < self.pixels.shape[1 - axis]:
+			if axis == 1:
+				return colorBreaks(self.pixels[indices], 1, self.threshold)
+			return colorBreaks(self.pixels[:, indices], 0, self.threshold).T
+		breaks = self.breaks(axis)
+		return breaks[indices] if axis == 1 else breaks[:, indices].T
+
+	def isLatticePoint(self, point):
+		'''
+		returns true if point is inside the grid and sits exactly on a pixel
+		'''
+		return point.isInBounds(self) and point.x == int(point.x) and point.y == int(point.y)
+
+	def traversalBreaks(self, start, direction, line=None):
+		'''
+		@params:
+			start is a lattice point to scan from
+			direction is an integer unit vector, as given by axisDirection
+			line is the break array of start's row or column, if already at hand
+		returns the breaks met walking from start in direction to the edge of the grid.
+			Element k is the break between the kth and (k+1)th pixel visited.
+		'''
+		x = int(start.x)
+		y = int(start.y)
+		if direction.y == 0:
+			row = self.breaks(1)[y] if line is None else line
+			return row[x:] if direction.x > 0 else row[:x][::-1]
+		column = self.breaks(0)[:, x] if line is None else line
+		return column[y:] if direction.y > 0 else column[:y][::-1]
+
+	def colorGroups(self, start, direction):
+		'''
+		@params:
+			start is a lattice point to scan from
+			direction is an integer unit vector, as given by axisDirection
+		returns the same list of Segments getColorGroups gives for this scan
+		'''
+		trav = self.traversalBreaks(start, direction)
+		splits = np.flatnonzero(trav).tolist()
+		run_starts = [0] + [k + 1 for k in splits]
+		run_ends = splits + [len(trav)]
+
+		def step(k):
+			return Point(start.x + k*direction.x, start.y + k*direction.y)
+
+		return [Segment(step(s), step(e)) for s, e in zip(run_starts, run_ends)]
+
+	def axisRuns(self, starts, direction):
+		'''
+		@params:
+			starts is a list of lattice points to scan from
+			direction is an integer unit vector, as given by axisDirection
+		returns a run array with one scanline per start, holding the same runs as
+			colorGroups would for each of them
+		'''
+		if len(starts) == 0:
+			return np.empty(0, dtype=np.int64), SegmentArray([], [])
+		axis = 1 if direction.y == 0 else 0
+		positions, which = np.unique([int(start.y) if axis == 1 else int(start.x) for start in starts],
+			return_inverse=True)
+		line_breaks = self.lineBreaks(axis, positions)
+		#Every scanline ends on its last pixel, so tack a True onto each one's breaks
+		lines = [np.append(self.traversalBreaks(start, direction, line_breaks[k]), True)
+			for start, k in zip(starts, which.tolist())]
+		ends = np.concatenate(lines)
+		counts = np.array([len(line) for line in lines])
+		offsets = np.concatenate(([0], np.cumsum(counts)))
+		origins = np.array([start.asTuple() for start in starts], dtype=np.float64)
+		return maskRuns(ends, offsets, origins, direction.asTuple())
+
+
+class ScanTable:
+	'''
+	Every scanline crossing a width x height image along one direction, stored as the flat
+	pixel indices each scanline samples. Tables only depend on the image size and angle,
+	so they are built by angleScanTable and shared between images.
+	'''
+	def __init__(self, indices, offsets, origins, direction):
+		self.indices = indices #flat pixel index of every sample, scanline after scanline
+		self.offsets = offsets #scanline i owns indices[offsets[i]:offsets[i+1]]
+		self.origins = origins #(x,y) of the first sample of each scanline
+		self.direction = direction #(dx,dy) step between samples
+		for array in (indices, offsets, origins):
+			array.setflags(write=False) #tables are shared through the cache
+
+	def __len__(self):
+		return len(self.offsets) - 1
+
+	@property
+	def nbytes(self):
+		return self.indices.nbytes + self.offsets.nbytes + self.origins.nbytes
+
+	def band(self, first, last):
+		'''
+		returns a ScanTable holding only scanlines first..last-1 of this one
+		'''
+		lo = self.offsets[first]
+		hi = self.offsets[last]
+		return ScanTable(self.indices[lo:hi], self.offsets[first:last + 1] - lo,
+			self.origins[first:last], self.direction)
+
+	def select(self, lines):
+		'''
+		returns a ScanTable holding only the given scanlines of this one, in the order given
+		'''
+		lines = np.asarray(lines, dtype=np.int64)
+		firsts = self.offsets[lines]
+		counts = self.offsets[lines + 1] - firsts
+		offsets = np.concatenate(([0], np.cumsum(counts)))
+		samples = np.repeat(firsts - offsets[:-1], counts) + np.arange(offsets[-1])
+		return ScanTable(self.indices[samples], offsets, self.origins[lines], self.direction)
+
+	def runs(self, grid):
+		'''
+		@params:
+			grid is the ScanGrid to sample, same size as this table
+		returns a run array of every scanline in this table.
+			All scanlines are gathered and diffed in one go.
+		'''
+		height, width, channels = grid.pixels.shape
+		samples = grid.pixels.reshape(-1, channels)[self.indices]
+		ends = np.empty(len(samples), dtype=bool)
+		ends[:-1] = np.abs(np.diff(samples, axis=0)).sum(axis=1) > grid.threshold
+		ends[-1] = True
+		ends[self.offsets[1:-1] - 1] = True #never join runs across two scanlines
+		return maskRuns(ends, self.offsets, self.origins, self.direction)
+
+
+class AxisScanTable:
+	'''
+	A ScanTable whose scanlines run along the rows or the columns. Those runs are read
+	straight off a ScanGrid's break arrays, several times quicker than a gather, so no
+	sample indices are stored, only the origins.
+	'''
+	def __init__(self, origins, direction):
+		self.origins = origins
+		self.direction = direction
+		origins.setflags(write=False)
+
+	def __len__(self):
+		return len(self.origins)
+
+	@property
+	def nbytes(self):
+		return self.origins.nbytes
+
+	def band(self, first, last):
+		'''
+		returns an AxisScanTable holding only scanlines first..last-1 of this one
+		'''
+		return AxisScanTable(self.origins[first:last], self.direction)
+
+	def select(self, lines):
+		'''
+		returns an AxisScanTable holding only the given scanlines of this one, in the order given
+		'''
+		return AxisScanTable(self.origins[np.asarray(lines, dtype=np.int64)], self.direction)
+
+	def runs(self, grid):
+		'''
+		returns a run array of every scanline in this table, as ScanTable.runs
+		'''
+		return grid.axisRuns([Point(x, y) for x, y in self.origins.tolist()], axisDirection(Point(*self.direction)))
+
+
+class DeferredScanTable:
+	'''
+	The scanlines of a ScanTable that hasn't been built, only their origins. Selecting
+	lines builds a table of just those, so a band of scanlines under a deadline costs
+	its share of the table rather than the whole of it. Nothing is cached.
+	'''
+	def __init__(self, width, height, origins, direction):
+		self.size = (width, height)
+		self.origins = origins
+		self.direction = direction
+
+	def __len__(self):
+		return len(self.origins)
+
+	def band(self, first, last):
+		'''
+		returns a table holding only scanlines first..last-1, built
+		'''
+		return originsScanTable(*self.size, self.origins[first:last], self.direction)
+
+	def select(self, lines):
+		'''
+		returns a table holding only the given scanlines, in the order given, built
+		'''
+		return originsScanTable(*self.size, self.origins[np.asarray(lines, dtype=np.int64)], self.direction)
+
+
+def angleScanTable(width, height, angle):
+	'''
+	@params:
+		width and height are the size of the images to scan
+		angle is the scan direction in radians, counter-clockwise from the x axis
+	returns a ScanTable with a scanline starting at every pixel of each edge the
+		direction enters the image through. Samples are truncated to pixels like getpixel does.
+		Along the rows or columns it is an AxisScanTable.
+		Results are cached in SCAN_TABLE_CACHE, so images of the same size reuse their tables.
+	'''
+	return SCAN_TABLE_CACHE.get(("edges", width, height, angle),
+		lambda: originsScanTable(width, height, *scanOrigins(width, height, angle)))
+
+
+def spacedScanTable(width, height, angle):
+	'''
+	@params:
+		width, height and angle are as in angleScanTable
+	returns a ScanTable like angleScanTable's, but with neighbouring scanlines one pixel
+		apart across the direction rather than starting on every edge pixel. Steep angles
+		in angleScanTable start many lines a fraction of a pixel apart on the edge they
+		nearly run along, and those lines sample the same pixels over and over.
+		Cached along with angleScanTable's tables.
+	'''
+	return SCAN_TABLE_CACHE.get(("spaced", width, height, angle),
+		lambda: originsScanTable(width, height, *scanOrigins(width, height, angle, True)))
+
+
+def deferredScanTable(width, height, angle, spaced=False):
+	'''
+	@params:
+		width, height and angle are as in angleScanTable
+		spaced defers spacedScanTable's table rather than angleScanTable's
+	returns the table if it is cached already, else a DeferredScanTable of its scanlines
+	'''
+	table = SCAN_TABLE_CACHE.peek(("spaced" if spaced else "edges", width, height, angle))
+	if table is None:
+		table = DeferredScanTable(width, height, *scanOrigins(width, height, angle, spaced))
+	return table
+
+
+def scanOrigins(width, height, angle, spaced=False):
+	'''
+	@params:
+		width, height and angle are as in angleScanTable
+		spaced gives spacedScanTable's scanlines rather than angleScanTable's
+	returns (origins, direction): the (n,2) array of where the table's scanlines start,
+		in its order, and the (dx,dy) step between samples, snapped onto an axis when it
+		runs along one. Tells how many scanlines a table has without building it, and
+		originsScanTable builds any of them.
+	'''
+	direction = Point(math.cos(angle), math.sin(angle))
+	axis = axisDirection(direction)
+	if axis is not None:
+		direction = axis
+	dx = float(direction.x)
+	dy = float(direction.y)
+
+	if spaced:
+		#Along an edge, starts 1/|component| apart are one pixel apart across the direction
+		origins = []
+		if dx != 0:
+			ys = np.arange(0, height, 1 / abs(dx))
+			origins.append(np.column_stack((np.full(len(ys), 0 if dx > 0 else width - 1), ys)))
+		if dy != 0:
+			xs = np.arange(0, width, 1 / abs(dy))
+			origins.append(np.column_stack((xs, np.full(len(xs), 0 if dy > 0 else height - 1))))
+		return np.unique(np.concatenate(origins).astype(np.float64), axis=0), (dx, dy)
+
+	#Scanlines start on the edges the direction points away from
+	starts = []
+	if dx > 0:
+		starts += [(0, y) for y in range(height)]
+	elif dx < 0:
+		starts += [(width - 1, y) for y in range(height)]
+	if dy > 0:
+		starts += [(x, 0) for x in range(width)]
+	elif dy < 0:
+		starts += [(x, height - 1) for x in range(width)]
+	return np.array(sorted(set(starts)), dtype=np.float64).reshape(-1, 2), (dx, dy)
+
+
+def originsScanTable(width, height, origins, direction):
+	'''
+	@params:
+		width, height, origins and direction are as in linesScanTable
+	returns an AxisScanTable if direction is an integer unit vector along an axis, as
+		scanOrigins gives them, and the linesScanTable otherwise
+	'''
+	if direction in ((1, 0), (-1, 0), (0, 1), (0, -1)):
+		return AxisScanTable(np.array(origins, dtype=np.float64).reshape(-1, 2), direction)
+	return linesScanTable(width, height, origins, direction)
+
+
+def dominantAngle(image, size=256):
+	'''
+	@params:
+		image is the PIL image to look at
+		size is roughly how many pixels wide to shrink image to first, as only the
+			overall direction of the edges matters
+	returns the angle in radians, from 0 up to pi/2, that most of the image's edges run
+		along or across. A QR code's module edges all run along its two axes, so for an
+		image mostly taken up by a code this is its rotation, modulo a right angle.
+		Gradient directions are averaged on a circle of period pi/2, weighted by the
+		squared gradient so strong edges count most.
+	'''
+	scale = max(max(image.size) // size, 1)
+	plane = image.convert("L")
+	if scale > 1:
+		plane = plane.resize((max(image.size[0] // scale, 1), max(image.size[1] // scale, 1)), Image.BOX)
+	plane = np.asarray(plane, dtype=np.float64)
+	if min(plane.shape) < 2:
+		return 0.0
+	gy, gx = np.gradient(plane)
+	weights = gx**2 + gy**2
+	angles = 4*np.arctan2(gy, gx)
+	angle = (math.atan2((weights*np.sin(angles)).sum(), (weights*np.cos(angles)).sum()) / 4) % (math.pi / 2)
+	return angle if angle < math.pi / 2 else 0.0 #a hair below 0 wraps round to pi/2
+
+
+def linesScanTable(width, height, origins, direction):
+	'''
+	@params:
+		width and height are the size of the images to scan
+		origins is an (n,2) array with the (x,y) each scanline starts from, inside the image
+		direction is the (dx,dy) step between samples
+	returns a ScanTable with a scanline from each origin to where it leaves the image.
+		Samples are truncated to pixels like getpixel does.
+	'''
+	origins = np.array(origins, dtype=np.float64).reshape(-1, 2)
+	dx, dy = float(direction[0]), float(direction[1])
+
+	#Number of steps each scanline stays inside the image for
+	counts = np.full(len(origins), np.inf)
+	for coord, delta, limit in ((origins[:, 0], dx, width), (origins[:, 1], dy, height)):
+		if delta > 0:
+			counts = np.minimum(counts, np.ceil((limit - coord) / delta))
+		elif delta < 0:
+			counts = np.minimum(counts, np.floor(coord / -delta) + 1)
+	counts = counts.astype(np.int64)
+
+	#Lay every scanline's samples end to end
+	line_ids = np.repeat(np.arange(len(origins)), counts)
+	firsts = np.repeat(np.cumsum(counts) - counts, counts)
+	steps = np.arange(len(line_ids)) - firsts
+	xs = np.floor(origins[line_ids, 0] + steps*dx).astype(np.int64)
+	ys = np.floor(origins[line_ids, 1] + steps*dy).astype(np.int64)
+
+	#Rounding can push the last step of a scanline just outside; drop those
+	inside = (xs >= 0) & (xs < width) & (ys >= 0) & (ys < height)
+	line_ids = line_ids[inside]
+	offsets = np.concatenate(([0], np.cumsum(np.bincount(line_ids, minlength=len(origins)))))
+	index_type = np.int32 if width*height < 2**31 else np.int64
+	indices = (ys[inside]*width + xs[inside]).astype(index_type)
+	return ScanTable(indices, offsets, origins, (dx, dy))
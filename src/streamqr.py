@@ -0,0 +1,161 @@
+#!/usr/bin/env python3
+import math
+import numpy as np
+from PIL import Image
+from mathutil import *
+from mathobjects import *
+import myqr
+
+'''
+Finding and replacing a QR code through a stream of video frames.
+
+Usage:
+	for frame in replaceInStream(frames, "https://example.com"):
+		writer.write(frame)
+
+NOTE:
+only keyframes, and frames where tracking was lost, get a full scan. Between them
+the tracker rescans a small window around each finder center of the last frame, so
+a frame costs about three finder patterns' worth of scanning however large it is.
+
+frames are processed one at a time as the iterator hands them over, so an output
+frame is ready as soon as its own input frame has been scanned and warped. No frame
+waits on a later one.
+'''
+
+
+class QRTracker:
+	'''
+	Follows the finder patterns of one QR code from frame to frame.
+	'''
+	def __init__(self, keyframe_interval=30, search_modules=4, max_scale_change=.25, binarize=False):
+		'''
+		@params:
+			keyframe_interval is how many frames may go by between full scans, 0 to only
+				rescan fully when tracking is lost
+			search_modules is how far, in modules, a finder pattern may move between frames
+				and still be found by the window rescan
+			max_scale_change is how much the code's sides may grow or shrink between frames,
+				as a fraction, before the track is treated as lost
+			binarize scans locally thresholded copies of the frames, see myqr.binarizeImage
+		'''
+		self.keyframe_interval = keyframe_interval
+		self.search_modules = search_modules
+		self.max_scale_change = max_scale_change
+		self.binarize = binarize
+		self.centers = None #the three finder centers of the last frame, None when lost
+		self.module_size = None
+		self.frames_since_keyframe = 0
+		self.full_scans = 0
+		self.tracked_frames = 0
+
+	def reset(self):
+		'''
+		forgets the track, so the next frame gets a full scan
+		'''
+		self.centers = None
+		self.module_size = None
+
+	def findCenters(self, frame):
+		'''
+		returns the three heaviest finder centers in the whole frame and the module size,
+			or (None, None) if there are fewer than three
+		'''
+		points = myqr.getMassQRClusters(frame, 2)
+		if len(points) == 0:
+			return None, None
+		points, weights = aggregatePoints(points)
+		module_size = estimateModuleSize(points, weights)
+		found = clusterPoints(points, max(1.5*module_size, 2), weights)
+		if len(found) < 3:
+			return None, None
+		return [Point(x, y) for (x, y), weight in found[:3]], module_size
+
+	def trackCenters(self, frame):
+		'''
+		returns the finder centers near the last frame's ones and the module size,
+			or (None, None) if any of them has gone missing
+		'''
+		width, height = frame.size
+		half = int(math.ceil((5 + self.search_modules) * self.module_size))
+		#Runs cut short by the window's edge can fake the ratio there, keep the middle only
+		keep = half - 2*self.module_size
+		centers = []
+		sizes = []
+		for center in self.centers:
+			box = (max(int(center.x) - half, 0), max(int(center.y) - half, 0),
+				min(int(center.x) + half + 1, width), min(int(center.y) + half + 1, height))
+			if box[2] <= box[0] or box[3] <= box[1]:
+				return None, None
+			offset = Point(box[0], box[1])
+			points = myqr.getMassQRClusters(frame.crop(box), 2) + offset
+			points = points[(abs(points.x - center.x) <= keep) & (abs(points.y - center.y) <= keep)]
+			if len(points) == 0:
+				return None, None
+			points, weights = aggregatePoints(points.xy)
+			found = clusterPoints(points, max(1.5*self.module_size, 2), weights)
+			#Another finder pattern can be in the window too, take the nearest clump
+			(x, y), weight = min(found, key=lambda cluster: center.distance(Point(*cluster[0])))
+			centers.append(Point(x, y))
+			sizes.append(estimateModuleSize(points, weights))
+
+		#A jump in size means a different pattern was picked up, not that the code moved
+		for a, b in ((0, 1), (1, 2), (0, 2)):
+			before = self.centers[a].distance(self.centers[b])
+			after = centers[a].distance(centers[b])
+			if before == 0 or abs(after/before - 1) > self.max_scale_change:
+				return None, None
+		return centers, float(np.median(sizes))
+
+	def update(self, frame):
+		'''
+		@params:
+			frame is the next RGB frame, as a PIL image
+		returns the parallelogram around the code in frame (as in myqr.scanImage2),
+			or None if there is no code to be found
+		'''
+		if self.binarize:
+			frame = myqr.binarizeImage(frame)
+		centers = None
+		keyframe = self.keyframe_interval and self.frames_since_keyframe >= self.keyframe_interval
+		if self.centers is not None and not keyframe:
+			centers, module_size = self.trackCenters(frame)
+			if centers is not None:
+				self.tracked_frames += 1
+				self.frames_since_keyframe += 1
+		if centers is None:
+			centers, module_size = self.findCenters(frame)
+			self.full_scans += 1
+			self.frames_since_keyframe = 0
+		self.centers = centers
+		self.module_size = module_size
+		if centers is None:
+			return None
+		return extrapolateParallelogram(*centers)
+
+
+def replaceInStream(frames, data, tracker=None, perspective=False, copy=False):
+	'''
+	@params:
+		frames is an iterable of frames, PIL images or (height, width, 3) uint8 arrays
+		data is what will be encoded in the replacement QR code
+		tracker is a QRTracker to use, a default one if not given
+		perspective is passed on to myqr.warpImage
+		copy leaves the input frames alone, otherwise the code is drawn onto them in place
+	yields each frame with its code replaced, or unchanged if no code was found, as soon
+		as that frame is done
+	'''
+	tracker = tracker or QRTracker()
+	#One bitmap for the whole stream, every frame warps the same code
+	code = myqr.makeQRImage(data)
+	for frame in frames:
+		if not isinstance(frame, Image.Image):
+			frame = Image.fromarray(np.asarray(frame, dtype=np.uint8))
+		elif copy:
+			frame = frame.copy()
+		if frame.mode != "RGB":
+			frame = frame.convert("RGB")
+		pgram = tracker.update(frame)
+		if pgram is not None:
+			frame = myqr.warpImage(frame, code, pgram, perspective)
+		yield frame
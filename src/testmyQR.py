@@ -3,6 +3,7 @@ import myqr
 from PIL import Image
 import qrcode
 import mathutil
+import qrtrace
 from sklearn.datasets.samples_generator import make_blobs
 from mathobjects import *
 
@@ -47,6 +48,8 @@ print("\nfinding consecutive similarly colored pixels")
 im3 = Image.open("../TestImages/TestClusters.png")
 im3 = im3.convert("RGB")
 print(myqr.getColorGroups(im3, Point(0,0), Point(1,0)))
+print("same scan off a ScanGrid")
+print(myqr.getColorGroups(myqr.ScanGrid(im3), Point(0,0), Point(1,0)))#should match the above
 
 #test extrapolateParallelogram
 p1 = Point(5,5)
@@ -75,9 +78,20 @@ print(mathutil.constructParallelograms(data))
 #test expandParallelogram
 print(mathutil.expandParallelogram(parallelogram, 4))
 print(myqr.getMassQRClusters(im, 1))
+print(myqr.getMassQRClusters(im, 4, gather=True))
 
 #test scanImage2
 print(myqr.scanImage2(im))
+print(myqr.scanImage2(im, pyramid_levels=1))#should be about the same
+print(myqr.scanImage2(Image.open("../TestImages/noisyqr.png"), binarize=True))
+
+#test findQR, one quadrilateral per code
+print(myqr.findQR(im))
+
+#test tracing
+with qrtrace.tracing() as trace:
+	myqr.scanImage2(im)
+print(trace)
 
 final = myqr.insertQR(im, 'hello world!')
 final.show()
@@ -0,0 +1,196 @@
+#!/usr/bin/env python3
+import math
+import os
+import shutil
+import numpy as np
+from PIL import Image
+from mathutil import *
+from mathobjects import *
+from scanlines import *
+import myqr
+
+'''
+Finding and replacing QR codes in images too big to hold in memory.
+
+NOTE:
+a raster is a NumPy array shaped (height, width, channels) of uint8. Binary PPM/PGM
+files (and headerless raw RGB dumps) are opened as np.memmap rasters, so only the
+parts being looked at are ever read from disk. Other formats have to be decoded whole
+by PIL, use convertToPPM once to turn them into something that can be mapped.
+
+a tile is a (core, halo) pair of boxes (left, top, right, bottom). Cores cover the image
+without overlapping; each halo is its core grown by the halo margin, so a finder pattern
+crossing a core's border is still seen whole by the tile that owns its center.
+'''
+
+#Tiles are scanned this many pixels square, plus the halo on every side
+TILE_SIZE = 2048
+#Widest finder pattern guaranteed to be caught on a tile border, in pixels
+HALO_SIZE = 256
+
+
+def readPNMHeader(raster_file):
+	'''
+	@params:
+		raster_file is a binary file opened at the start of a P5 or P6 PNM file
+	returns (width, height, channels, offset) where offset is where the pixels start
+	'''
+	fields = []
+	token = b""
+	while len(fields) < 4:
+		char = raster_file.read(1)
+		if char == b"":
+			raise ValueError("truncated PNM header")
+		if char == b"#": #comments run to the end of the line
+			raster_file.readline()
+			continue
+		if char.isspace():
+			if token:
+				fields.append(token)
+				token = b""
+			continue
+		token += char
+	magic, width, height, maxval = fields
+	if magic not in (b"P5", b"P6") or int(maxval) > 255:
+		raise ValueError("only 8 bit binary PGM/PPM files can be mapped")
+	return int(width), int(height), 3 if magic == b"P6" else 1, raster_file.tell()
+
+
+def openRaster(path, mode="r", size=None):
+	'''
+	@params:
+		path is the image to open
+		mode is "r" to read, "r+" to change the file in place
+		size is the (width, height) of a headerless .rgb/.raw file
+	returns a raster of the image. PNM and raw files are memory-mapped; anything
+		else is decoded whole by PIL, which is only bounded by the image size.
+	'''
+	if size is not None:
+		width, height = size
+		return np.memmap(path, dtype=np.uint8, mode=mode, shape=(height, width, 3))
+	with open(path, "rb") as raster_file:
+		magic = raster_file.read(2)
+		raster_file.seek(0)
+		if magic in (b"P5", b"P6"):
+			width, height, channels, offset = readPNMHeader(raster_file)
+			return np.memmap(path, dtype=np.uint8, mode=mode, offset=offset,
+				shape=(height, width, channels))
+	return np.asarray(Image.open(path).convert("RGB"))
+
+
+def convertToPPM(path, ppm_path):
+	'''
+	Decodes path once with PIL and writes it as a binary PPM that openRaster can map.
+	'''
+	Image.open(path).convert("RGB").save(ppm_path, format="PPM")
+
+
+def tileBoxes(size, tile=TILE_SIZE, halo=HALO_SIZE):
+	'''
+	@params:
+		size is the (width, height) of the image
+		tile is the side of each core box
+		halo is the margin added around each core box
+	returns a list of tiles covering the image
+	'''
+	width, height = size
+	tiles = []
+	for top in range(0, height, tile):
+		for left in range(0, width, tile):
+			core = (left, top, min(left + tile, width), min(top + tile, height))
+			halo_box = (max(left - halo, 0), max(top - halo, 0),
+				min(core[2] + halo, width), min(core[3] + halo, height))
+			tiles.append((core, halo_box))
+	return tiles
+
+
+def tiledQRClusters(raster, num_vectors=2, gather=False, tile=TILE_SIZE, halo=HALO_SIZE):
+	'''
+	@params:
+		raster is a raster, usually memory-mapped
+		num_vectors and gather are as in myqr.getMassQRClusters
+		tile and halo are as in tileBoxes
+	returns an (n,2) array of finder candidates for the whole raster.
+		Each tile keeps only the candidates inside its core, so none are counted twice.
+		At most one tile plus its halo is held in memory at a time.
+	'''
+	height, width = raster.shape[:2]
+	found = []
+	for core, (left, top, right, bottom) in tileBoxes((width, height), tile, halo):
+		grid = ScanGrid(np.asarray(raster[top:bottom, left:right], dtype=np.int16))
+		points = myqr.getMassQRClusters(grid, num_vectors, gather)
+		if len(points) == 0:
+			continue
+		points = points.xy + (left, top)
+		inside = ((points[:, 0] >= core[0]) & (points[:, 0] < core[2]) &
+			(points[:, 1] >= core[1]) & (points[:, 1] < core[3]))
+		found.append(points[inside])
+	if len(found) == 0:
+		return np.empty((0, 2))
+	return np.concatenate(found)
+
+
+def tiledScanImage(raster, num_vectors=2, gather=False, tile=TILE_SIZE, halo=HALO_SIZE):
+	'''
+	returns the parallelogram around the QR code in raster, like myqr.scanImage2,
+		finding candidates tile by tile, or None if there is none
+	'''
+	points = tiledQRClusters(raster, num_vectors, gather, tile, halo)
+	return constructParallelograms(points)
+
+
+def tiledWarpImage(raster, image, parallelogram, perspective=False, tile=TILE_SIZE):
+	'''
+	@params:
+		raster is a writable raster (eg openRaster(path, "r+"))
+		image, parallelogram and perspective are as in myqr.warpImage
+		tile is the side of the boxes that are read, composited and written back
+	composites image into raster in place, touching only the tiles the
+		parallelogram overlaps
+	'''
+	height, width = raster.shape[:2]
+	corners = list(parallelogram[:4])
+	if not perspective:
+		corners[3] = parallelogram[0] + parallelogram[2] - parallelogram[1]
+	left = max(int(math.floor(min(p.x for p in corners))), 0)
+	top = max(int(math.floor(min(p.y for p in corners))), 0)
+	right = min(int(math.ceil(max(p.x for p in corners))) + 1, width)
+	bottom = min(int(math.ceil(max(p.y for p in corners))) + 1, height)
+
+	image = image.convert("RGB")
+	for core, halo_box in tileBoxes((width, height), tile, 0):
+		if core[2] <= left or core[0] >= right or core[3] <= top or core[1] >= bottom:
+			continue
+		origin = Point(core[0], core[1])
+		pixels = raster[core[1]:core[3], core[0]:core[2]]
+		#Only drop the band axis, an edge tile can be a single pixel high or wide
+		bands = np.ascontiguousarray(pixels)
+		background = Image.fromarray(bands[:, :, 0] if bands.shape[2] == 1 else bands)
+		if background.mode != "RGB":
+			background = background.convert("RGB")
+		shifted = [p - origin for p in parallelogram]
+		result = np.asarray(myqr.warpImage(background, image, shifted, perspective))
+		pixels[:] = result.reshape(pixels.shape[:2] + (-1,))[:, :, :pixels.shape[2]]
+	if isinstance(raster, np.memmap):
+		raster.flush()
+
+
+def tiledInsertQR(path, data, output_path, perspective=False, tile=TILE_SIZE, halo=HALO_SIZE):
+	'''
+	@params:
+		path is a PPM/PGM image, see openRaster
+		data is what will be encoded in the QR code
+		output_path is where the result goes, a copy of path with the code replaced
+		perspective is as in myqr.warpImage
+		tile and halo are as in tileBoxes
+	Like myqr.insertQR, with memory use bounded by the tile size rather than the image size.
+	raises ValueError if no code is found to replace, before output_path is written
+	'''
+	pgram = tiledScanImage(openRaster(path), tile=tile, halo=halo)
+	if pgram is None:
+		raise ValueError("no QR code found to replace")
+	if os.path.abspath(path) != os.path.abspath(output_path):
+		shutil.copyfile(path, output_path)
+	raster = openRaster(output_path, "r+")
+	tiledWarpImage(raster, myqr.makeQRImage(data), pgram, perspective, tile)
+	return pgram